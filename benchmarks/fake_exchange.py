@@ -0,0 +1,126 @@
+""" Local stand-in for the DPLA Exchange cart API used by the benchmarks.
+
+POST /carts creates a cart and answers with its Location. PATCH /carts/<id>
+accepts a chunk of items, plain or gzip compressed, after `latency` seconds,
+or fails with a 503 for a `error_rate` fraction of the requests.
+"""
+import json
+import random
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class FakeExchangeStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.items_received = 0
+        self._lock = threading.Lock()
+
+    def add(self, body_size, items=0, error=False):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += body_size
+            self.items_received += items
+            self.errors += int(error)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes_received": self.bytes_received,
+            "items_received": self.items_received,
+        }
+
+
+class FakeExchangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _respond(self, status, body=None, headers=None):
+        payload = json.dumps(body or {}).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.stats.add(len(body))
+        with self.server.lock:
+            self.server.carts += 1
+            cart_id = self.server.carts
+        self._respond(201, headers={
+            "Location": "http://%s:%d/carts/%d" % (
+                self.server.server_address[0], self.server.server_address[1], cart_id
+            ),
+        })
+
+    def do_PATCH(self):
+        body = self._read_body()
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.server.stats.add(len(body), error=True)
+            self._respond(503)
+            return
+        try:
+            if self.headers.get("Content-Encoding") == "gzip":
+                body_json = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            else:
+                body_json = body
+            items = len(json.loads(body_json.decode("utf-8")).get("items", []))
+        except (ValueError, zlib.error):
+            items = 0
+        self.server.stats.add(len(body), items=items)
+        self._respond(200, {"items": []})
+
+
+class FakeExchangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeExchangeHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = FakeExchangeStats()
+        self.carts = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
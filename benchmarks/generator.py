@@ -0,0 +1,101 @@
+""" Synthetic libraries, collections and license pools for the benchmarks. """
+import random
+
+from core.model.collection import Collection, collections_libraries
+from core.model.configuration import ExternalIntegration
+from core.model.datasource import DataSource
+from core.model.identifier import Equivalency, Identifier
+from core.model.library import Library
+from core.model.licensing import LicensePool
+
+
+class LicensePoolGenerator(object):
+    """ Populate `libraries` x `collections` x `pools` license pools.
+
+    Each library gets its own collections. `isbn_ratio` of the pools use an
+    ISBN identifier; the others use an Overdrive id which, for
+    `equivalency_ratio` of them, is equivalent to an ISBN. Availability and
+    hold queues are spread so every kind of cart gets items.
+    """
+
+    def __init__(self, _db, libraries=1, collections=1, pools=1000, isbn_ratio=0.5,
+                 equivalency_ratio=0.8, seed=42):
+        self._db = _db
+        self.libraries = libraries
+        self.collections = collections
+        self.pools = pools
+        self.isbn_ratio = isbn_ratio
+        self.equivalency_ratio = equivalency_ratio
+        self.random = random.Random(seed)
+        self._identifier_count = 0
+
+    def _identifier(self, identifier_type):
+        self._identifier_count += 1
+        identifier = Identifier(
+            type=identifier_type, identifier="979%010d" % self._identifier_count
+        )
+        self._db.add(identifier)
+        return identifier
+
+    def _license_pools(self, collection, data_source):
+        identifiers = []
+        for _ in range(self.pools):
+            equivalent = None
+            if self.random.random() < self.isbn_ratio:
+                identifier = self._identifier(Identifier.ISBN)
+            else:
+                identifier = self._identifier(Identifier.OVERDRIVE_ID)
+                if self.random.random() < self.equivalency_ratio:
+                    equivalent = self._identifier(Identifier.ISBN)
+            identifiers.append((identifier, equivalent))
+        self._db.flush()
+
+        for identifier, equivalent in identifiers:
+            if equivalent is not None:
+                self._db.add(Equivalency(
+                    input_id=identifier.id, output_id=equivalent.id,
+                    data_source_id=data_source.id, strength=1,
+                ))
+            self._db.add(LicensePool(
+                collection_id=collection.id, identifier_id=identifier.id,
+                data_source_id=data_source.id, open_access=self.random.random() < 0.05,
+                licenses_available=self.random.choice([0, 0, 1, 3, 5, 10, 50]),
+                patrons_in_hold_queue=self.random.choice([0, 0, 0, 2, 6, 20]),
+            ))
+        self._db.flush()
+
+    def populate(self):
+        """ Create the rows and return the generated libraries. """
+        data_source = DataSource(name="Benchmark Exchange")
+        self._db.add(data_source)
+        self._db.flush()
+
+        libraries = []
+        for library_number in range(self.libraries):
+            library = Library(
+                name="Benchmark library %d" % library_number,
+                short_name="bench-%d" % library_number,
+            )
+            self._db.add(library)
+            self._db.flush()
+            libraries.append(library)
+
+            for collection_number in range(self.collections):
+                integration = ExternalIntegration(
+                    protocol="benchmark", goal="licenses",
+                    name="Benchmark %d-%d" % (library_number, collection_number),
+                )
+                self._db.add(integration)
+                self._db.flush()
+                collection = Collection(
+                    name="Benchmark collection %d-%d" % (library_number, collection_number),
+                    external_integration_id=integration.id,
+                )
+                self._db.add(collection)
+                self._db.flush()
+                self._db.execute(collections_libraries.insert().values(
+                    collection_id=collection.id, library_id=library.id
+                ))
+
+                self._license_pools(collection, data_source)
+        return libraries
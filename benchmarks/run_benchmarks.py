@@ -0,0 +1,271 @@
+""" Benchmarks of the cart pipeline hot paths.
+
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --database-url postgres://.../simplified_test
+
+Without a database URL only the scenarios that don't touch the database run
+(chunk_dict, serialize and send_items). The database scenarios populate synthetic rows
+in a transaction that is rolled back at the end, so a test database can be
+reused. Results are written as JSON so runs can be compared.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_exchange import FakeExchangeServer
+from itertools import repeat
+from cm_plugin_cart_api_exchange.cart_api_items import Item
+from cm_plugin_cart_api_exchange.cart_api_json import available_serializers, gzip_bytes
+from cm_plugin_cart_api_exchange.cart_api_operations import (
+    ExchangeApi,
+    RetryPolicy,
+    batch_items,
+    chunk_dict,
+)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+class Measurement(object):
+    """ Wall time, DB queries, HTTP requests and peak memory of a scenario. """
+
+    def __init__(self, name, query_recorder=None, server=None, trace_memory=True, **parameters):
+        self.name = name
+        self.query_recorder = query_recorder
+        self.server = server
+        # Tracing allocations slows Python code down, which skews CPU timings
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.parameters = parameters
+        self.extra = {}
+
+    def __enter__(self):
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+        self._queries = self.query_recorder.count() if self.query_recorder else 0
+        self._requests = self.server.stats.requests if self.server else 0
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds = time.time() - self._started
+        if self.trace_memory:
+            self.peak_memory_kb = tracemalloc.get_traced_memory()[1] // 1024
+            self.memory_source = "tracemalloc"
+            tracemalloc.stop()
+        else:
+            self.peak_memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.memory_source = "maxrss"
+        self.db_queries = (self.query_recorder.count() - self._queries
+                           if self.query_recorder else 0)
+        self.http_requests = (self.server.stats.requests - self._requests
+                              if self.server else 0)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "parameters": self.parameters,
+            "wall_seconds": round(self.wall_seconds, 4),
+            "db_queries": self.db_queries,
+            "http_requests": self.http_requests,
+            "peak_memory_kb": self.peak_memory_kb,
+            "memory_source": self.memory_source,
+            "extra": self.extra,
+        }
+
+
+def synthetic_items(count):
+    for n in range(count):
+        yield Item("979%010d" % n, n % 7)
+
+
+def scenario_chunk_dict(args):
+    with Measurement("chunk_dict", items=args.items, chunk_size=args.chunk_size) as m:
+        chunks = 0
+        for chunk in chunk_dict(synthetic_items(args.items), args.chunk_size):
+            chunks += 1
+        m.extra["chunks"] = chunks
+    return [m]
+
+
+def scenario_serialize(args):
+    """ Bytes on the wire and CPU time per chunk of each serializer, with and without gzip. """
+    bodies = [
+        {"name": "bench", "total": {"items": len(chunk), "copies": chunk.total_copies},
+         "items": chunk.entries()}
+        for chunk in batch_items(synthetic_items(args.items), repeat(args.chunk_size))
+    ]
+    measurements = []
+    for serializer in available_serializers():
+        for compress in (False, True):
+            with Measurement("serialize", trace_memory=False, serializer=serializer.name,
+                             gzip=compress, items=args.items, chunk_size=args.chunk_size) as m:
+                size = 0
+                started = cpu_time()
+                for body in bodies:
+                    content = serializer.dumps(body)
+                    if compress:
+                        content = gzip_bytes(content)
+                    size += len(content)
+                cpu_seconds = cpu_time() - started
+            m.extra["bytes_per_chunk"] = size // max(1, len(bodies))
+            m.extra["cpu_ms_per_chunk"] = round(cpu_seconds * 1000 / max(1, len(bodies)), 3)
+            measurements.append(m)
+    return measurements
+
+
+def scenario_send_items(args):
+    measurements = []
+    for workers, gzip in sorted(set([(1, False), (args.workers, False), (args.workers, True)])):
+        with FakeExchangeServer(args.latency, args.error_rate) as server:
+            exchange_api = ExchangeApi(
+                "bench", "bench", max_workers=workers,
+                retry_policy=RetryPolicy(max_retries=0), gzip=gzip,
+            )
+            with Measurement("send_items", server=server, items=args.items,
+                             chunk_size=args.chunk_size, workers=workers, gzip=gzip,
+                             latency=args.latency, error_rate=args.error_rate) as m:
+                result = exchange_api.send_items(
+                    server.url + "/carts/1", synthetic_items(args.items), "bench",
+                    args.chunk_size
+                )
+            exchange_api.close()
+            m.extra.update(server.stats.as_dict())
+            m.extra["total_with_error"] = result.total_with_error
+            measurements.append(m)
+    return measurements
+
+
+def database_scenarios(args):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from core.model.plugin_configuration import PluginConfiguration
+    from cm_plugin_cart_api_exchange.cart_api_queries import QueryRecorder
+    from cm_plugin_cart_api_exchange.cart_api_scripts import (
+        CART_KEYS,
+        KEY_PASSWORD,
+        KEY_USER,
+        TRUE_VALUE,
+        CartApiScript,
+    )
+    from generator import LicensePoolGenerator
+
+    engine = create_engine(args.database_url)
+    query_recorder = QueryRecorder(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    _db = Session(bind=connection)
+    measurements = []
+    try:
+        generator = LicensePoolGenerator(
+            _db, args.libraries, args.collections, args.pools,
+            args.isbn_ratio, args.equivalency_ratio,
+        )
+        with Measurement("populate", query_recorder, libraries=args.libraries,
+                         collections=args.collections, pools=args.pools) as m:
+            libraries = generator.populate()
+        measurements.append(m)
+
+        script = CartApiScript(_db=_db)
+        with Measurement("licenses_query", query_recorder, libraries=args.libraries) as m:
+            licenses = [script._classify_licenses(library, CART_KEYS, None)
+                        for library in libraries]
+        m.extra["licenses"] = sum(len(rows) for by_cart in licenses for rows in by_cart.values())
+        measurements.append(m)
+
+        with Measurement("items_from_licenses", query_recorder,
+                         isbn_ratio=args.isbn_ratio,
+                         equivalency_ratio=args.equivalency_ratio) as m:
+            items = 0
+            for by_cart in licenses:
+                for rows in by_cart.values():
+                    for _ in script._get_items_from_licenses(rows):
+                        items += 1
+        m.extra["items"] = items
+        m.extra["isbn_cache_hits"] = script.isbn_cache.hits
+        m.extra["isbn_cache_misses"] = script.isbn_cache.misses
+        measurements.append(m)
+        del licenses
+
+        plugin_name = "cart-api-benchmark"
+        for library in libraries:
+            for key, value in [(KEY_USER, "bench"), (KEY_PASSWORD, "bench")] + \
+                    [(cart_key, TRUE_VALUE) for cart_key in CART_KEYS]:
+                _db.add(PluginConfiguration(
+                    library_id=library.id, key=plugin_name + "." + key, _value=value
+                ))
+        _db.flush()
+
+        with FakeExchangeServer(args.latency, args.error_rate) as server:
+            create_cart_uri = ExchangeApi.CREATE_CART_URI
+            ExchangeApi.CREATE_CART_URI = server.url + "/carts"
+            try:
+                script = CartApiScript(_db=_db, upload_workers=args.workers,
+                                       query_recorder=query_recorder)
+                query_recorder.reset()
+                with Measurement("run", query_recorder, server, workers=args.workers,
+                                 latency=args.latency, error_rate=args.error_rate) as m:
+                    script.run(plugin_name)
+            finally:
+                ExchangeApi.CREATE_CART_URI = create_cart_uri
+            m.extra.update(server.stats.as_dict())
+            m.extra["queries_per_phase"] = query_recorder.phases()
+            measurements.append(m)
+    finally:
+        query_recorder.detach()
+        _db.close()
+        transaction.rollback()
+        connection.close()
+    return measurements
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--database-url", help="Database for the DB scenarios.")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default.")
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--libraries", type=int, default=2)
+    parser.add_argument("--collections", type=int, default=2)
+    parser.add_argument("--pools", type=int, default=2000)
+    parser.add_argument("--isbn-ratio", type=float, default=0.5)
+    parser.add_argument("--equivalency-ratio", type=float, default=0.8)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    measurements = scenario_chunk_dict(args) + scenario_serialize(args) + \
+        scenario_send_items(args)
+    if args.database_url:
+        measurements += database_scenarios(args)
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "scenarios": [m.as_dict() for m in measurements],
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class IsbnCache(object):
+    """ Bounded LRU cache of identifier id -> resolved ISBN.
+
+    Entries older than `ttl` seconds count as misses. With a `path`, the
+    cache can be saved at the end of a run and loaded by the next one.
+    The whole cache is dropped when `validate` is given a different
+    version than the one it was filled with, which callers derive from
+    the equivalency rows.
+
+    Attributes:
+        hits (int): lookups answered by the cache.
+        misses (int): lookups that had to go to the database.
+    """
+    MAX_SIZE = 200000
+    TTL = 30 * 24 * 60 * 60
+
+    def __init__(self, max_size=None, ttl=None, path=None, clock=time.time):
+        self.max_size = max_size or self.MAX_SIZE
+        self.ttl = ttl or self.TTL
+        self.path = path
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, identifier_id):
+        """ The cached ISBN, or None. """
+        with self._lock:
+            entry = self._entries.pop(identifier_id, None)
+            if entry is None or self._clock() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            # Re-insert to mark it as the most recently used
+            self._entries[identifier_id] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, identifier_id, isbn):
+        with self._lock:
+            self._entries.pop(identifier_id, None)
+            self._entries[identifier_id] = (isbn, self._clock())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def validate(self, version):
+        """ Drop every entry if `version` differs from the cached one. """
+        if self.version is not None and version != self.version:
+            logging.info("Equivalencies changed, dropping %d cached ISBNs.", len(self))
+            self.invalidate()
+        self.version = version
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError) as err:
+            logging.warning("Cannot load ISBN cache %s. %s", self.path, err)
+            return
+
+        now = self._clock()
+        with self._lock:
+            self.version = data.get("version")
+            self._entries.clear()
+            for identifier_id, isbn, stored_at in data.get("entries", []):
+                if now - stored_at <= self.ttl:
+                    self._entries[identifier_id] = (isbn, stored_at)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "version": self.version,
+                "entries": [[identifier_id, isbn, stored_at] for identifier_id, (isbn, stored_at)
+                            in self._entries.items()],
+            }
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(data, cache_file, separators=(",", ":"))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            logging.warning("Cannot save ISBN cache %s. %s", self.path, err)
+
+
+class CollectionLicenseCache(object):
+    """ License rows of the collections shared by several libraries.
+
+    Entries are keyed by collection id and cart predicate, a (kind of
+    cart, vendor id or None) pair, so each shared collection is scanned
+    once per run whatever the number of libraries using it. Each
+    collection is reference counted by the libraries still to run, and
+    its entries are dropped once the last of them calls `release`.
+
+    Attributes:
+        hits (int): entries answered by the cache.
+        misses (int): entries that had to be queried.
+    """
+
+    def __init__(self, library_collections):
+        """ `library_collections` maps the library ids to run to their collection ids. """
+        self.hits = 0
+        self.misses = 0
+        self._library_collections = dict(
+            (library_id, list(collection_ids))
+            for library_id, collection_ids in library_collections.items()
+        )
+        self._refcounts = {}
+        for collection_ids in self._library_collections.values():
+            for collection_id in collection_ids:
+                self._refcounts[collection_id] = self._refcounts.get(collection_id, 0) + 1
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def collections(self, library_id):
+        """ Collection ids of a library, or None if it isn't tracked or was released. """
+        with self._lock:
+            collection_ids = self._library_collections.get(library_id)
+            return None if collection_ids is None else list(collection_ids)
+
+    def is_shared(self, collection_id):
+        """ Whether caching the collection saves a scan to another library. """
+        with self._lock:
+            return self._refcounts.get(collection_id, 0) > 1 or collection_id in self._entries
+
+    def lock(self, collection_id):
+        """ Lock to hold while filling the entries of a collection. """
+        with self._lock:
+            return self._locks.setdefault(collection_id, threading.Lock())
+
+    def get(self, collection_id, predicate):
+        with self._lock:
+            rows = self._entries.get(collection_id, {}).get(predicate)
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rows
+
+    def set(self, collection_id, predicate, rows):
+        with self._lock:
+            if self._refcounts.get(collection_id):
+                self._entries.setdefault(collection_id, {})[predicate] = rows
+
+    def release(self, library_id):
+        """ Mark a library as done. Releasing it again does nothing. """
+        with self._lock:
+            for collection_id in self._library_collections.pop(library_id, []):
+                self._refcounts[collection_id] -= 1
+                if self._refcounts[collection_id] <= 0:
+                    del self._refcounts[collection_id]
+                    self._entries.pop(collection_id, None)
+                    self._locks.pop(collection_id, None)
@@ -0,0 +1,184 @@
+""" Optional PostgreSQL indexes for the cart queries, and a check of their use.
+
+    python -m cm_plugin_cart_api_exchange.cart_api_indexes create
+    python -m cm_plugin_cart_api_exchange.cart_api_indexes explain --library <short name>
+    python -m cm_plugin_cart_api_exchange.cart_api_indexes drop
+
+`create` can be run any number of times: existing indexes are kept, and
+invalid ones left by an interrupted concurrent build are rebuilt.
+`explain` prints the plans of the plugin queries, to compare them before
+and after creating the indexes.
+"""
+from core.model.library import Library
+from core.model.licensing import LicensePool
+from core.scripts import Script
+from sqlalchemy import text
+from cart_api_scripts import CART_KEYS, CARTS, EXPIRED, CartApiScript
+
+import argparse
+import logging
+import time
+
+from contextlib import contextmanager
+
+
+# name -> (table, columns and predicate). The predicates repeat the SQL
+# of `cart_filter` and `open_access.is_(False)` as rendered, so the
+# planner can match them with the queries.
+INDEXES = [
+    ("ix_cart_api_licensepools_expired", "licensepools",
+     "(collection_id, identifier_id) "
+     "WHERE open_access IS false AND licenses_available = 0"),
+    ("ix_cart_api_licensepools_expiring", "licensepools",
+     "(collection_id, identifier_id) "
+     "WHERE open_access IS false AND licenses_available > 0 AND licenses_available <= 5"),
+    ("ix_cart_api_licensepools_long_queue", "licensepools",
+     "(collection_id, identifier_id) "
+     "WHERE open_access IS false AND patrons_in_hold_queue > 5"),
+    ("ix_cart_api_licensepools_vendor", "licensepools",
+     "(data_source_id, collection_id, identifier_id) WHERE open_access IS false"),
+    # Changed identifiers and last change of the incremental scans
+    ("ix_cart_api_licensepools_last_checked", "licensepools",
+     "(collection_id, last_checked, identifier_id)"),
+    # Index only scans for the ISBN resolution
+    ("ix_cart_api_identifiers_lookup", "identifiers",
+     "(id, type, identifier)"),
+    ("ix_cart_api_equivalents_lookup", "equivalents",
+     "(input_id, strength DESC NULLS LAST, output_id)"),
+]
+
+
+class CartApiIndexScript(Script):
+    """ Create, drop and check the indexes of `INDEXES`. """
+
+    def existing_indexes(self):
+        """ Dict of the plugin index names found -> whether they are valid. """
+        rows = self._db.execute(text(
+            "SELECT c.relname, i.indisvalid FROM pg_class c "
+            "JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname IN :names"
+        ).bindparams(names=tuple(name for name, _, _ in INDEXES)))
+        return dict((name, valid) for name, valid in rows)
+
+    def create_indexes(self, concurrently=True):
+        """ Create the missing indexes. Returns the names of the created ones.
+
+        Concurrent builds don't lock the tables against writes, but can't
+        run inside a transaction, so they use an autocommit connection.
+        """
+        existing = self.existing_indexes()
+        created = []
+        with self._ddl_connection(concurrently) as execute:
+            for name, table, definition in INDEXES:
+                if existing.get(name):
+                    continue
+                if name in existing:
+                    logging.warning("Rebuilding invalid index %s.", name)
+                    execute("DROP INDEX %s IF EXISTS %s" % (
+                        "CONCURRENTLY" if concurrently else "", name))
+                logging.info("Creating index %s.", name)
+                started = time.time()
+                execute("CREATE INDEX %s IF NOT EXISTS %s ON %s %s" % (
+                    "CONCURRENTLY" if concurrently else "", name, table, definition))
+                logging.info("Created index %s in %.1fs.", name, time.time() - started)
+                created.append(name)
+        return created
+
+    def drop_indexes(self, concurrently=True):
+        """ Drop the plugin indexes. Returns the names of the dropped ones. """
+        existing = self.existing_indexes()
+        with self._ddl_connection(concurrently) as execute:
+            for name in existing:
+                logging.info("Dropping index %s.", name)
+                execute("DROP INDEX %s IF EXISTS %s" % (
+                    "CONCURRENTLY" if concurrently else "", name))
+        return sorted(existing)
+
+    @contextmanager
+    def _ddl_connection(self, concurrently):
+        """ Yield a function executing DDL statements, in the session's
+        transaction or, for concurrent builds, on an autocommit connection. """
+        if not concurrently:
+            yield lambda statement: self._db.execute(text(statement))
+            return
+        # Concurrent builds wait for the transactions open on the tables
+        self._db.commit()
+        bind = self._db.get_bind()
+        engine = getattr(bind, "engine", bind)
+        connection = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            yield lambda statement: connection.execute(text(statement))
+        finally:
+            connection.close()
+
+    def explain(self, library, vendor_id=None, analyze=False):
+        """ EXPLAIN plans of the plugin queries for a library.
+
+        Returns a list of (query name, plan lines). With `analyze` the
+        queries are run, to get actual row counts and timings.
+        """
+        cart_script = CartApiScript(_db=self._db)
+        identifier_ids = [identifier_id for identifier_id, in cart_script._get_licenses_query(
+            library, None, LicensePool.identifier_id
+        ).limit(cart_script.ISBN_BATCH_SIZE)] or [0]
+        vendor_carts = [cart_key for cart_key in CART_KEYS if CARTS[cart_key][1]]
+        queries = [
+            ("classify", cart_script._get_classify_query(library, CART_KEYS, None)),
+            ("stream_expired", cart_script._stream_licenses(library, None, EXPIRED)),
+            ("changed_identifiers", cart_script._get_changed_identifiers_query(
+                library, time.time() - cart_script.FULL_RESCAN_SECONDS)),
+            ("identifiers", cart_script._get_identifiers_query(identifier_ids)),
+            ("equivalent_isbns", cart_script._get_equivalent_isbns_query(identifier_ids)),
+        ]
+        if vendor_id:
+            queries.insert(1, ("classify_vendor", cart_script._get_classify_query(
+                library, vendor_carts, int(vendor_id))))
+
+        dialect = self._db.get_bind().dialect
+        plans = []
+        for name, query in queries:
+            sql = str(query.statement.compile(
+                dialect=dialect, compile_kwargs={"literal_binds": True}
+            ))
+            rows = self._db.execute(text(
+                ("EXPLAIN ANALYZE " if analyze else "EXPLAIN ") + sql
+            ))
+            plans.append((name, [line for line, in rows]))
+        return plans
+
+    def run(self, cmd_args=None):
+        parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+        parser.add_argument("command", choices=["create", "drop", "explain"])
+        parser.add_argument("--library", help="Short name of the library to explain.")
+        parser.add_argument("--vendor", type=int, help="Datasource id of the DPLA carts.")
+        parser.add_argument("--analyze", action="store_true",
+                            help="Run the explained queries.")
+        parser.add_argument("--in-transaction", action="store_true",
+                            help="Don't build or drop the indexes concurrently.")
+        args = parser.parse_args(cmd_args)
+
+        if args.command == "create":
+            created = self.create_indexes(concurrently=not args.in_transaction)
+            logging.info("Created %d of %d indexes.", len(created), len(INDEXES))
+        elif args.command == "drop":
+            self.drop_indexes(concurrently=not args.in_transaction)
+        else:
+            libraries = self._db.query(Library)
+            if args.library:
+                libraries = libraries.filter(Library.short_name == args.library)
+            library = libraries.first()
+            if library is None:
+                logging.error("No library to explain.")
+                return
+            for name, plan in self.explain(library, args.vendor, args.analyze):
+                print("-- %s" % name)
+                for line in plan:
+                    print(line)
+                if any("Seq Scan on licensepools" in line for line in plan):
+                    logging.warning("%s scans licensepools sequentially.", name)
+        if args.in_transaction:
+            self._db.commit()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    CartApiIndexScript().run()
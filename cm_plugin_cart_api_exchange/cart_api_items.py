@@ -0,0 +1,67 @@
+from array import array
+
+
+class Item(object):
+    """ A title to put in a cart: its ISBN and the number of copies. """
+    __slots__ = ("identifier", "copies")
+
+    def __init__(self, identifier, copies):
+        self.identifier = identifier
+        self.copies = copies
+
+    def __eq__(self, other):
+        return isinstance(other, Item) and \
+            (self.identifier, self.copies) == (other.identifier, other.copies)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Item(%r, %r)" % (self.identifier, self.copies)
+
+
+class ItemBatch(object):
+    """ A chunk of items kept as parallel arrays of identifiers and copies.
+
+    Items can be Item records or, for older callers, dicts with
+    "identifier" and "copies" keys. Missing copies count as zero.
+    """
+    __slots__ = ("identifiers", "copies")
+
+    def __init__(self):
+        self.identifiers = []
+        self.copies = array("l")
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def append(self, item):
+        if isinstance(item, dict):
+            self.add(item.get("identifier", ""), item.get("copies", 0))
+        else:
+            self.add(item.identifier, item.copies)
+
+    def add(self, identifier, copies):
+        self.identifiers.append(identifier)
+        self.copies.append(copies or 0)
+
+    def extend(self, other):
+        self.identifiers.extend(other.identifiers)
+        self.copies.extend(other.copies)
+
+    def split(self, size):
+        """ Consecutive batches of at most `size` items. """
+        for start in range(0, len(self), size):
+            batch = ItemBatch()
+            batch.identifiers = self.identifiers[start:start + size]
+            batch.copies = self.copies[start:start + size]
+            yield batch
+
+    @property
+    def total_copies(self):
+        return sum(self.copies)
+
+    def entries(self):
+        """ The items as entries of a cart API request. """
+        return [{"id": identifier, "quantity": copies}
+                for identifier, copies in zip(self.identifiers, self.copies)]
@@ -0,0 +1,67 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonSerializer(object):
+    """ Encode request bodies to compact JSON bytes with the standard library. """
+    name = "json"
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class UjsonSerializer(JsonSerializer):
+    name = "ujson"
+
+    def dumps(self, data):
+        content = ujson.dumps(data, escape_forward_slashes=False)
+        return content if isinstance(content, bytes) else content.encode("utf-8")
+
+
+class OrjsonSerializer(JsonSerializer):
+    name = "orjson"
+
+    def dumps(self, data):
+        return orjson.dumps(data)
+
+
+def available_serializers():
+    """ Serializers usable in this environment, fastest first. """
+    serializers = []
+    if orjson is not None:
+        serializers.append(OrjsonSerializer())
+    if ujson is not None:
+        serializers.append(UjsonSerializer())
+    serializers.append(JsonSerializer())
+    return serializers
+
+
+def default_serializer():
+    return available_serializers()[0]
+
+
+def gzip_bytes(content, level=6):
+    """ Compress `content` in the gzip format expected for Content-Encoding: gzip. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+
+class EncodedBody(object):
+    """ Request body encoded once, so retries send the same bytes. """
+    __slots__ = ("content", "size", "content_encoding")
+
+    def __init__(self, content, size=None, content_encoding=None):
+        self.content = content
+        # Size of the JSON before compression
+        self.size = size or len(content)
+        self.content_encoding = content_encoding
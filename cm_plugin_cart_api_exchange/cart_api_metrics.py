@@ -0,0 +1,153 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+_phases = threading.local()
+
+
+def _tags_key(tags):
+    return tuple(sorted((tags or {}).items()))
+
+
+def current_phase():
+    """ Name of the innermost `timed` block running on this thread, or None. """
+    stack = getattr(_phases, "stack", None)
+    return stack[-1] if stack else None
+
+
+class MetricsSink(object):
+    """ Receives phase timings and counts of a cart run.
+
+    This base sink drops everything; subclasses override `timing`, `count`
+    and, when they buffer, `flush`. Tags are a dict such as
+    {"library": ..., "cart": ...}.
+    """
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+    def count(self, name, value=1, tags=None):
+        pass
+
+    def flush(self):
+        pass
+
+    @contextmanager
+    def timed(self, name, tags=None):
+        if not hasattr(_phases, "stack"):
+            _phases.stack = []
+        _phases.stack.append(name)
+        started = time.time()
+        try:
+            yield
+        finally:
+            _phases.stack.pop()
+            self.timing(name, time.time() - started, tags)
+
+
+class InMemoryMetrics(MetricsSink):
+    """ Thread safe counters and timing aggregates kept in process. """
+
+    def __init__(self):
+        self._timings = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def timing(self, name, seconds, tags=None):
+        key = (name, _tags_key(tags))
+        with self._lock:
+            count, total, maximum = self._timings.get(key, (0, 0.0, 0.0))
+            self._timings[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def count(self, name, value=1, tags=None):
+        key = (name, _tags_key(tags))
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+
+    def timings(self):
+        """ List of timing aggregates, slowest total first. """
+        with self._lock:
+            timings = [
+                {"name": name, "tags": dict(tags), "count": count,
+                 "total_seconds": total, "max_seconds": maximum}
+                for (name, tags), (count, total, maximum) in self._timings.items()
+            ]
+        return sorted(timings, key=lambda t: t["total_seconds"], reverse=True)
+
+    def counts(self):
+        with self._lock:
+            return [{"name": name, "tags": dict(tags), "value": value}
+                    for (name, tags), value in sorted(self._counts.items())]
+
+    def total(self, name, by=None):
+        """ Total seconds of a timing, per value of the `by` tag. """
+        totals = {}
+        for timing in self.timings():
+            if timing["name"] == name:
+                key = timing["tags"].get(by) if by else None
+                totals[key] = totals.get(key, 0) + timing["total_seconds"]
+        return totals
+
+
+class JsonFileMetrics(InMemoryMetrics):
+    """ Write the aggregated metrics to a JSON file on `flush`. """
+
+    def __init__(self, path):
+        super(JsonFileMetrics, self).__init__()
+        self.path = path
+
+    def flush(self):
+        data = {"timings": self.timings(), "counts": self.counts()}
+        try:
+            with open(self.path, "w") as metrics_file:
+                json.dump(data, metrics_file, indent=2, sort_keys=True)
+        except (IOError, OSError) as err:
+            logging.warning("Cannot write metrics to %s. %s", self.path, err)
+
+
+class StatsdMetrics(MetricsSink):
+    """ Emit each measure as a StatsD UDP packet, with DogStatsD style tags. """
+
+    def __init__(self, host="localhost", port=8125, prefix="cart_api"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind, tags):
+        line = "%s.%s:%s|%s" % (self.prefix, name, value, kind)
+        if tags:
+            line += "|#" + ",".join("%s:%s" % item for item in _tags_key(tags))
+        try:
+            self._socket.sendto(line.encode("utf-8"), self.address)
+        except (IOError, OSError) as err:
+            logging.debug("Cannot send metric %s. %s", name, err)
+
+    def timing(self, name, seconds, tags=None):
+        self._send(name, int(round(seconds * 1000)), "ms", tags)
+
+    def count(self, name, value=1, tags=None):
+        self._send(name, value, "c", tags)
+
+
+class MultiMetrics(MetricsSink):
+    """ Fan out every measure to several sinks. """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def timing(self, name, seconds, tags=None):
+        for sink in self.sinks:
+            sink.timing(name, seconds, tags)
+
+    def count(self, name, value=1, tags=None):
+        for sink in self.sinks:
+            sink.count(name, value, tags)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
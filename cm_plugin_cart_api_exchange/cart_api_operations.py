@@ -1,22 +1,351 @@
 import requests
+import hashlib
+import json
 import logging
+import random
+import threading
+import time
 
+from collections import deque
+from contextlib import contextmanager
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial
+from itertools import chain, islice, repeat
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.compat import urlparse
+
+from cart_api_items import ItemBatch
+from cart_api_json import EncodedBody, default_serializer, gzip_bytes
+from cart_api_metrics import MetricsSink
 
 
 def chunk_dict(target, size):
-    values = list(target.values())
-    for n in range(0, len(values), size):
-        yield values[n:size + n]
+    """ Split the values of a dict, or any iterable, in lists of `size`.
+
+    Values are pulled lazily, so only one chunk is held at a time.
+    """
+    return chunk_items(target, repeat(size))
+
+
+def chunk_items(target, sizes):
+    """ Like chunk_dict, with the size of each chunk read from `sizes`. """
+    values = iter(target.values() if hasattr(target, "values") else target)
+    for size in sizes:
+        chunk = list(islice(values, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unique_items(target, on_duplicate=None):
+    """ Items of `target` without those repeating the identifier of an earlier
+    one, such as an Overdrive id and its equivalent ISBN. The first wins.
+
+    `on_duplicate` is called with each dropped item.
+    """
+    seen = set()
+    for item in (target.values() if hasattr(target, "values") else target):
+        identifier = item.get("identifier", "") if isinstance(item, dict) else item.identifier
+        if identifier in seen:
+            if on_duplicate is not None:
+                on_duplicate(item)
+            continue
+        seen.add(identifier)
+        yield item
+
+
+def batch_items(target, sizes):
+    """ Like chunk_items, filling an ItemBatch per chunk. """
+    values = iter(target.values() if hasattr(target, "values") else target)
+    for size in sizes:
+        batch = ItemBatch()
+        for item in islice(values, size):
+            batch.append(item)
+        if not batch:
+            return
+        yield batch
+
+
+class RequestCancelled(Exception):
+    """ Raised for requests of a cancelled AsyncExchangeApi call. """
+
+
+def parse_retry_after(response):
+    """ Seconds to wait according to the Retry-After header, or None. """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter for failed requests.
+
+    Connection errors and the statuses in RETRY_STATUSES are retried up to
+    `max_retries` times. The n-th retry waits a random time between zero
+    and `backoff_factor * 2 ** n` seconds, capped by `max_backoff`, unless
+    the server asks for a specific delay with Retry-After.
+    """
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, max_retries=3, backoff_factor=1.0, max_backoff=60, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def should_retry(self, retries, response=None, error=None):
+        if retries >= self.max_retries or isinstance(error, RequestCancelled):
+            return False
+        if error is not None:
+            return True
+        return response.status_code in self.RETRY_STATUSES
+
+    def delay(self, retries, response=None):
+        retry_after = parse_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** retries))
+
+
+class TokenBucket(object):
+    """ Thread safe rate limiter allowing `rate` requests per second.
+
+    Up to `capacity` requests may go out in a burst; after that callers of
+    `acquire` block until the bucket refills.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, rate)
+        self._tokens = float(self.capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                missing = (tokens - self._tokens) / self.rate
+            self._sleep(missing)
+
+
+class SendResult(object):
+    """ Item counts of a `send_items` call.
+
+    `failed` is an ItemBatch of the items the server rejected one by one
+    in otherwise accepted chunks.
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.total = 0
+        self.total_with_error = 0
+        # chunk number -> retries, only for chunks that needed any
+        self.retries = {}
+        self.failed = ItemBatch()
+
+    @property
+    def total_retries(self):
+        return sum(self.retries.values())
+
+    def add_chunk(self, chunk_number, sent, with_error, retries=0, failed=None,
+                  resent=False):
+        """ Account for a chunk. A `resent` chunk only holds items already counted. """
+        if not resent:
+            self.chunks += 1
+            self.total += sent
+        self.total_with_error += with_error
+        if retries:
+            self.retries[chunk_number] = self.retries.get(chunk_number, 0) + retries
+        if failed:
+            self.failed.extend(failed)
+
+
+class AdaptiveChunkSize(object):
+    """ Chunk size following the observed PATCH requests.
+
+    After each request the size moves halfway towards the number of items
+    that would take `target_seconds` at the measured throughput, at most
+    doubling at once and without exceeding `max_body_bytes` of JSON.
+    Failed requests halve it. It always stays within `min_size` and
+    `max_size`. Iterating gives the current size, chunk after chunk.
+    """
+    MIN_SIZE = 100
+    MAX_SIZE = 5000
+    TARGET_SECONDS = 10.0
+    MAX_BODY_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, initial=1000, min_size=None, max_size=None, target_seconds=None,
+                 max_body_bytes=None):
+        self.min_size = min_size or self.MIN_SIZE
+        self.max_size = max_size or self.MAX_SIZE
+        self.target_seconds = target_seconds or self.TARGET_SECONDS
+        self.max_body_bytes = max_body_bytes or self.MAX_BODY_BYTES
+        self.size = max(self.min_size, min(self.max_size, initial))
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        while True:
+            yield self.size
+
+    def observe(self, items, seconds, body_bytes=None, failed=False):
+        with self._lock:
+            if failed:
+                size = self.size / 2.0
+            else:
+                size = items * self.target_seconds / max(seconds, 0.001)
+                if body_bytes:
+                    size = min(size, items * self.max_body_bytes / float(body_bytes))
+                size = self.size + (min(size, self.size * 2) - self.size) / 2.0
+            size = int(max(self.min_size, min(self.max_size, size)))
+            if size != self.size:
+                logging.debug("Chunk size %d -> %d. %d items in %.2fs.", self.size, size,
+                              items, seconds)
+            self.size = size
+
+
+class SendCheckpoint(object):
+    """ Leading chunks of an upload acknowledged by the server.
+
+    `previous` holds the content hashes of the chunks a former, interrupted
+    upload got accepted, and `previous_sizes` their sizes, which the new
+    upload reuses for its first chunks. Chunks are skipped while they hash
+    the same as those, which relies on the items being sent in a stable
+    order. Each chunk accepted afterwards extends `chunk_hashes`, until the
+    first one with errors, and `on_progress` is called with the checkpoint
+    every `interval` accepted chunks so it can be persisted.
+    """
+
+    def __init__(self, previous=None, previous_sizes=None, on_progress=None, interval=1):
+        self.previous = list(previous or [])
+        self.previous_sizes = list(previous_sizes or [])
+        self.chunk_hashes = []
+        self.chunk_sizes = []
+        self.on_progress = on_progress
+        self.interval = max(1, interval)
+        self.skipped = 0
+        self._resuming = True
+        self._broken = False
+        self._pending = {}
+
+    @staticmethod
+    def hash_chunk(chunk):
+        as_json = json.dumps([chunk.identifiers, chunk.copies.tolist()], separators=(",", ":"))
+        return hashlib.sha1(as_json.encode("utf-8")).hexdigest()[:16]
+
+    def skip_acknowledged(self, chunks):
+        """ Filter (chunk number, chunk) pairs, dropping the already accepted ones. """
+        for chunk_number, chunk in chunks:
+            chunk_hash = self.hash_chunk(chunk)
+            if self._resuming and chunk_number <= len(self.previous) and \
+                    self.previous[chunk_number - 1] == chunk_hash:
+                self.chunk_hashes.append(chunk_hash)
+                self.chunk_sizes.append(len(chunk))
+                self.skipped += len(chunk)
+                continue
+            self._resuming = False
+            self._pending[chunk_number] = (chunk_hash, len(chunk))
+            yield chunk_number, chunk
+
+    def acknowledge(self, chunk_number, accepted):
+        """ Record the outcome of a chunk. Outcomes must come in chunk order. """
+        chunk_hash, size = self._pending.pop(chunk_number)
+        if self._broken or not accepted:
+            self._broken = True
+            return
+        self.chunk_hashes.append(chunk_hash)
+        self.chunk_sizes.append(size)
+        if self.on_progress and len(self.chunk_hashes) % self.interval == 0:
+            self.on_progress(self)
 
 
 class ExchangeApi(object):
+    """ Client for the DPLA Exchange cart API.
+
+    Requests go through a single keep-alive session so that consecutive
+    calls reuse the same pooled connections. Use it as a context manager or
+    call `close` when done.
+
+    PATCH bodies are encoded once per chunk with `serializer`. With `gzip`,
+    bodies of GZIP_MIN_BYTES or more are sent compressed, unless the
+    endpoint answered a compressed body with 415 Unsupported Media Type.
+    """
     CREATE_CART_URI = "https://market.feedbooks.com/carts"
+    POOL_SIZE = 10
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 120
+    MAX_WORKERS = 1
+    # Passes resending only the items rejected one by one
+    FAILED_ITEM_PASSES = 1
+    GZIP = False
+    GZIP_MIN_BYTES = 1024
 
-    def __init__(self, user, password):
+    def __init__(self, user, password, pool_size=None, timeout=None, max_workers=None,
+                 retry_policy=None, rate_limiter=None, metrics=None, chunk_sizer=None,
+                 serializer=None, gzip=None):
         self.user = user
         self.password = password
-    
+        self.max_workers = max_workers or self.MAX_WORKERS
+        self.pool_size = pool_size or max(self.POOL_SIZE, self.max_workers)
+        self.timeout = timeout or (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or MetricsSink()
+        self.chunk_sizer = chunk_sizer
+        self.serializer = serializer or default_serializer()
+        self.gzip = self.GZIP if gzip is None else gzip
+        # Endpoints that refused compressed bodies
+        self._plain_endpoints = set()
+        self._session = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        session.auth = HTTPBasicAuth(self.user, self.password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     def create_cart(self, cart_name):
         request_body = {
             "name": cart_name,
@@ -31,67 +360,356 @@ class ExchangeApi(object):
         except:
             raise Exception("Cannot create cart")
 
-    @classmethod
-    def _items_to_api_request_entry(cls, work):
-        return {
-            "id": work.get("identifier", ""),
-            "quantity": work.get("copies", 0),
-        }
+    def send_items(self, url, items, cart_name, chunk_size=None, max_workers=None,
+                   metric_tags=None, checkpoint=None):
+        """ Send `items` to the cart at `url` in chunks of `chunk_size`.
 
-    def send_items(self, url, items, cart_name, chunk_size=1000):
-        total = 0
-        total_with_error = 0
-        current_chunk = 0
-        for chunk in chunk_dict(items, chunk_size):
-            current_chunk += 1
-            total += len(chunk)
+        `items` is a dict of Item records or any iterable of them; it is
+        consumed lazily, one ItemBatch at a time. Without `chunk_size`,
+        chunks follow the `chunk_sizer` of the client if it has one, or
+        hold 1000 items.
+
+        Items repeating the identifier of an earlier item are dropped, so
+        with `max_workers` greater than one, when up to that many chunks
+        are in flight at once, the order in which the server applies them
+        does not matter. Outcomes are still accounted for in chunk order so
+        the result is deterministic.
+
+        Chunk building and PATCH timings, and the final counts, go to the
+        metrics sink tagged with `metric_tags`.
+
+        With a SendCheckpoint, chunks accepted by a previous attempt are
+        skipped and newly accepted ones are recorded in it.
+
+        Items the server rejects individually are sent again, on their own,
+        up to FAILED_ITEM_PASSES times.
+
+        Returns a SendResult.
+        """
+        max_workers = max_workers or self.max_workers
+        chunk_sizer = None if chunk_size else self.chunk_sizer
+        sizes = chunk_sizer or repeat(chunk_size or 1000)
+        if checkpoint is not None:
+            sizes = chain(checkpoint.previous_sizes, sizes)
+        duplicates = []
+        items = unique_items(items, duplicates.append)
+        chunks = enumerate(batch_items(items, sizes), 1)
+        if checkpoint is not None:
+            chunks = checkpoint.skip_acknowledged(chunks)
+        if max_workers > 1:
+            outcomes = self._send_chunks_concurrently(url, cart_name, chunks, max_workers,
+                                                      metric_tags)
+        else:
+            outcomes = (self._send_chunk(url, cart_name, chunk_number, chunk, metric_tags)
+                        for chunk_number, chunk in chunks)
+
+        result = SendResult()
+        for outcome in outcomes:
+            result.add_chunk(*outcome)
+            if checkpoint is not None:
+                checkpoint.acknowledge(outcome[0], outcome[2] == 0)
+
+        for _ in range(self.FAILED_ITEM_PASSES):
+            if not result.failed:
+                break
+            failed, result.failed = result.failed, ItemBatch()
+            logging.info("Resending %d items with error.", len(failed))
+            result.total_with_error -= len(failed)
+            for batch in failed.split(chunk_size or 1000):
+                outcome = self._send_chunk(url, cart_name, result.chunks + 1, batch,
+                                           metric_tags)
+                result.add_chunk(*outcome, resent=True)
+
+        if chunk_sizer is not None:
+            logging.info("Chunk size settled at %d items.", chunk_sizer.size)
+        if duplicates:
+            logging.info("Dropped %d items repeating an identifier.", len(duplicates))
+            self.metrics.count("items_duplicated", len(duplicates), metric_tags)
+        if checkpoint is not None and checkpoint.skipped:
+            logging.info("Skipped %d items already accepted.", checkpoint.skipped)
+            self.metrics.count("items_skipped", checkpoint.skipped, metric_tags)
+        self.metrics.count("items_sent", result.total, metric_tags)
+        self.metrics.count("items_with_error", result.total_with_error, metric_tags)
+        self.metrics.count("chunk_retries", result.total_retries, metric_tags)
+
+        logging.info("Sent %d. %d with error. %d retries.",
+                     result.total, result.total_with_error, result.total_retries)
+        if result.retries:
+            logging.info("Retried chunks: %s", ", ".join(
+                "%d (x%d)" % (chunk_number, retries)
+                for chunk_number, retries in sorted(result.retries.items())
+            ))
+        return result
+
+    def _send_chunks_concurrently(self, url, cart_name, chunks, max_workers, metric_tags=None):
+        pool = ThreadPool(max_workers)
+        pending = deque()
+        send_chunk = self._bind_call(self._send_chunk)
+        try:
+            for chunk_number, chunk in chunks:
+                # Only pull the next chunk once a slot is free, so at most
+                # `max_workers` chunks are held in memory.
+                if len(pending) >= max_workers:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(
+                    send_chunk, (url, cart_name, chunk_number, chunk, metric_tags)
+                ))
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _bind_call(self, function):
+        """ `function`, to run on another thread on behalf of the current call. """
+        return function
+
+    def _send_chunk(self, url, cart_name, chunk_number, chunk, metric_tags=None):
+        """ Send one chunk, retrying transient failures.
+
+        Returns a (chunk_number, sent, with_error, retries, failed) tuple,
+        where `failed` is an ItemBatch of the items rejected one by one.
+        """
+        with self.metrics.timed("chunk_build", metric_tags):
             request_body_as_dict = {
                 "name": cart_name,
                 "total": {
                     "items": len(chunk),
-                    "copies": sum([item.get("copies", 0) for item in chunk]),
+                    "copies": chunk.total_copies,
                 },
                 # "values": {
                 #     "USD": sum([w.get("price", 0) for w in chunk]),
                 # },
-                "items": [self._items_to_api_request_entry(item)
-                          for item in chunk],
+                "items": chunk.entries(),
             }
+            body = self._encode_body(url, request_body_as_dict)
+
+        retries = 0
+        while True:
+            response, error = None, None
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            started = time.time()
             try:
-                response = self._make_patch_request(url, request_body_as_dict)
+                response = self._make_patch_request(url, request_body_as_dict, body=body)
             except Exception as err:
-                total_with_error += len(chunk)
-                logging.warning("Error sending items. Chunk %d. %s", current_chunk, err)
+                error = err
+            seconds = time.time() - started
+            self.metrics.timing("http_patch", seconds, metric_tags)
+            self.metrics.count("request_bytes", len(body.content), metric_tags)
+            if error is None and response.status_code == 415 and body.content_encoding:
+                endpoint = urlparse(url).netloc
+                logging.info("%s does not accept %s bodies.", endpoint, body.content_encoding)
+                self._plain_endpoints.add(endpoint)
+                body = self._encode_body(url, request_body_as_dict)
                 continue
+            if self.chunk_sizer is not None:
+                self.chunk_sizer.observe(len(chunk), seconds, body.size, failed=(
+                    error is not None or response.status_code == 413 or
+                    response.status_code >= 500
+                ))
+            if error is None and response.status_code < 300:
+                break
 
-            if response.status_code < 300:
-                if "items" in response.json():
-                    entries = response.json()
-                    for entry in entries["items"]:
-                        if "error" in entries["items"] and entries["items"]["error"]:
-                            total_with_error += 1
-            else:
-                total_with_error += len(chunk)
-                logging.error("Cannot send values. %d. %s", response.status_code, response.content)
+            if not self.retry_policy.should_retry(retries, response, error):
+                break
+            delay = self.retry_policy.delay(retries, response)
+            retries += 1
+            logging.warning("Retrying chunk %d in %.1fs (retry %d). %s", chunk_number,
+                            delay, retries, error or response.status_code)
+            self.retry_policy.sleep(delay)
+
+        if error is not None:
+            logging.warning("Error sending items. Chunk %d. %s", chunk_number, error)
+            return chunk_number, len(chunk), len(chunk), retries, None
+
+        if response.status_code >= 300:
+            logging.error("Cannot send values. %d. %s", response.status_code, response.content)
+            return chunk_number, len(chunk), len(chunk), retries, None
 
-        logging.info("Sent %d. %d with error.", total, total_with_error)
+        failed, unknown = self._failed_items(chunk, response)
+        if failed or unknown:
+            logging.warning("Chunk %d. %d items with error.", chunk_number,
+                            len(failed) + unknown)
+        return chunk_number, len(chunk), len(failed) + unknown, retries, failed
 
+    @staticmethod
+    def _failed_items(chunk, response):
+        """ Items of `chunk` with an error entry in the response.
+
+        The body is parsed once. Returns an ItemBatch of the failed items and
+        the number of error entries that match no item of the chunk.
+        """
+        failed, unknown = ItemBatch(), 0
+        try:
+            body = response.json()
+        except ValueError:
+            return failed, unknown
+        entries = body.get("items") if isinstance(body, dict) else None
+        if isinstance(entries, dict):
+            entries = [entries]
+
+        positions = None
+        for entry in entries or []:
+            if not isinstance(entry, dict) or not entry.get("error"):
+                continue
+            if positions is None:
+                positions = dict((identifier, n) for n, identifier
+                                 in enumerate(chunk.identifiers))
+            position = positions.get(entry.get("id"))
+            if position is None:
+                unknown += 1
+            else:
+                failed.add(chunk.identifiers[position], chunk.copies[position])
+        return failed, unknown
 
     def _make_get_request(self, url, data):
         headers = {
             "Content-Type": "application/json",
         }
-        return requests.post(
-            url, json=data, headers=headers,
-            auth=HTTPBasicAuth(self.user, self.password)
+        return self.session.post(
+            url, json=data, headers=headers, timeout=self.timeout
         )
 
-    def _make_patch_request(self, url, data):
+    def _encode_body(self, url, data):
+        content = self.serializer.dumps(data)
+        if self.gzip and len(content) >= self.GZIP_MIN_BYTES and \
+                urlparse(url).netloc not in self._plain_endpoints:
+            return EncodedBody(gzip_bytes(content), len(content), "gzip")
+        return EncodedBody(content)
+
+    def _make_patch_request(self, url, data, body=None):
+        if body is None:
+            body = self._encode_body(url, data)
         headers = {
             "Content-Type": "application/vnd.demarque.market.cart+json",
         }
-        return requests.patch(
-            url, json=data, headers=headers,
-            auth=HTTPBasicAuth(self.user, self.password)
+        if body.content_encoding:
+            headers["Content-Encoding"] = body.content_encoding
+        return self.session.patch(
+            url, data=body.content, headers=headers, timeout=self.timeout
         )
 
+
+
+class PendingCall(object):
+    """ A call running on the pool of an AsyncExchangeApi.
+
+    `get` waits for its value. When it times out the call is cancelled:
+    its requests that have not started fail with RequestCancelled.
+    """
+
+    def __init__(self, result, cancelled):
+        self._result = result
+        self._cancelled = cancelled
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        try:
+            return self._result.get(timeout)
+        except PoolTimeoutError:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+class AsyncExchangeApi(ExchangeApi):
+    """ ExchangeApi whose calls can also run in the background.
+
+    `create_cart_async` and `send_items_async` take the arguments of
+    `create_cart` and `send_items` and return a PendingCall right away.
+    `create_cart` and `send_items` keep blocking in the calling thread.
+    No more than `concurrency` HTTP requests of the client run at the same
+    time, whether they come from background or blocking calls. `cancel`
+    makes every request that has not started yet fail with RequestCancelled.
+
+    Items given to `send_items_async` are consumed on a pool thread, so they
+    must not be read from a database session used meanwhile.
+    """
+    CONCURRENCY = 4
+
+    def __init__(self, user, password, concurrency=None, **kwargs):
+        super(AsyncExchangeApi, self).__init__(user, password, **kwargs)
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.pool_size = max(self.pool_size, self.concurrency)
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+        self._cancelled = threading.Event()
+        self._local = threading.local()
+        self._pool = None
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def create_cart_async(self, *args, **kwargs):
+        return self._submit(self.create_cart, args, kwargs)
+
+    def send_items_async(self, *args, **kwargs):
+        return self._submit(self.send_items, args, kwargs)
+
+    def _submit(self, function, args, kwargs):
+        cancelled = threading.Event()
+        result = self.pool.apply_async(self._call, (cancelled, function) + args, kwargs)
+        return PendingCall(result, cancelled)
+
+    def _call(self, cancelled, function, *args, **kwargs):
+        """ Run `function` with the cancellation event of its call. """
+        previous = getattr(self._local, "cancelled", None)
+        self._local.cancelled = cancelled
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._local.cancelled = previous
+
+    def _bind_call(self, function):
+        cancelled = getattr(self._local, "cancelled", None)
+        if cancelled is None:
+            return function
+        return partial(self._call, cancelled, function)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        if self._cancelled.is_set():
+            return True
+        call_cancelled = getattr(self._local, "cancelled", None)
+        return call_cancelled is not None and call_cancelled.is_set()
+
+    def close(self):
+        """ Wait for pending calls, then release threads and connections. """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        super(AsyncExchangeApi, self).close()
+
+    @contextmanager
+    def _request_slot(self):
+        if self.cancelled:
+            raise RequestCancelled()
+        with self._semaphore:
+            if self.cancelled:
+                raise RequestCancelled()
+            yield
+
+    def _make_get_request(self, url, data):
+        with self._request_slot():
+            return super(AsyncExchangeApi, self)._make_get_request(url, data)
+
+    def _make_patch_request(self, url, data, body=None):
+        with self._request_slot():
+            return super(AsyncExchangeApi, self)._make_patch_request(url, data, body)
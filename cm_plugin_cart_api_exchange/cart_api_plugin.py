@@ -13,8 +13,59 @@ from cart_api_scripts import (
 )
 from cart_api_scripts import CartApiScript, GetDatasourcesScript
 
+import logging
+import time
+
+
+class DatasourceOptions(object):
+    """ Datasource choices of the admin interface, loaded on first use.
+
+    The options are cached for `ttl` seconds, or until `invalidate` is
+    called. If the database cannot be reached, the last known options
+    (or none) are returned and loading is retried on the next access.
+    """
+    TTL = 60 * 60
+
+    def __init__(self, ttl=None, clock=time.time):
+        self.ttl = ttl or self.TTL
+        self._clock = clock
+        self._options = None
+        self._loaded_at = None
+
+    def get(self):
+        if self._options is None or self._clock() - self._loaded_at > self.ttl:
+            try:
+                script = GetDatasourcesScript()
+                try:
+                    self._options = script.get_datasources()
+                    self._loaded_at = self._clock()
+                finally:
+                    # Each script opens a session of its own
+                    script._db.close()
+            except Exception as err:
+                logging.warning("Cannot load datasources. %s", err)
+                return self._options or []
+        return self._options
+
+    def invalidate(self):
+        self._options = None
+
+
+class LazyFields(object):
+    """ Descriptor returning plugin fields with up to date datasource options. """
+
+    def __init__(self, fields, datasource_options):
+        self.fields = fields
+        self.datasource_options = datasource_options
+
+    def __get__(self, instance, owner):
+        fields = []
+        for field in self.fields:
+            if field["key"] == KEY_DATASOURCE:
+                field = dict(field, options=self.datasource_options.get())
+            fields.append(field)
+        return fields
 
-datasources = GetDatasourcesScript().get_datasources()
 
 class CartApiPlugin(object):
     """ Cart API Plugin entry point.
@@ -26,11 +77,15 @@ class CartApiPlugin(object):
         FREQUENCY (int, optional): integer represing minimum hours to execute.
         SCRIPTS (list): List of scripts to run in the backend of CM.
         FIELDS (list): List of fields to add in the admin interface of CM.
+            Datasource options are read from the database on first access.
+        DATASOURCE_OPTIONS (DatasourceOptions): cache of the datasource
+            options, call `invalidate` on it to reload them.
     """
 
     FREQUENCY = 24*5 # 5 days min of frequency
     SCRIPTS = [CartApiScript]
-    FIELDS = [
+    DATASOURCE_OPTIONS = DatasourceOptions()
+    FIELDS = LazyFields([
         {
             "key": KEY_USER,
             "label": "Username",
@@ -49,7 +104,7 @@ class CartApiPlugin(object):
             "key": KEY_DATASOURCE,
             "label": "Datasources",
             "description": "Select DPLA datasource.",
-            "options": datasources,
+            "options": [],
             "type": "select",
             "required": True,
         },
@@ -126,7 +181,7 @@ class CartApiPlugin(object):
             "required": False,
         },
         
-    ]
+    ], DATASOURCE_OPTIONS)
 
     def activate(self, app):
         """ No routes is add with this plugin. """
@@ -0,0 +1,127 @@
+from sqlalchemy import event
+from cart_api_metrics import current_phase
+
+import heapq
+import logging
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+OTHER_PHASE = "other"
+
+
+class QueryRecorder(object):
+    """ Count and time the statements executed through an engine or connection.
+
+    Statements are grouped by the metrics phase running on the thread
+    that executed them (see `MetricsSink.timed`), or OTHER_PHASE outside
+    of any. For each phase the recorder keeps the number of statements,
+    their total time and the SLOWEST slowest ones.
+
+    In tests, `assert_max_queries` fails when a block runs more statements
+    than expected:
+
+        with recorder.assert_max_queries(5):
+            script._run_expired_items(...)
+    """
+    SLOWEST = 5
+    STATEMENT_LENGTH = 500
+
+    def __init__(self, bind=None, slowest=None):
+        self.slowest = slowest or self.SLOWEST
+        self._bind = None
+        self._phases = {}
+        self._captures = []
+        self._lock = threading.Lock()
+        if bind is not None:
+            self.attach(bind)
+
+    def attach(self, bind):
+        self.detach()
+        event.listen(bind, "before_cursor_execute", self._before_execute)
+        event.listen(bind, "after_cursor_execute", self._after_execute)
+        self._bind = bind
+
+    def detach(self):
+        if self._bind is None:
+            return
+        event.remove(self._bind, "before_cursor_execute", self._before_execute)
+        event.remove(self._bind, "after_cursor_execute", self._after_execute)
+        self._bind = None
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()
+
+    def _before_execute(self, connection, cursor, statement, parameters, context,
+                        executemany):
+        connection.info.setdefault("cart_api_query_started", []).append(time.time())
+
+    def _after_execute(self, connection, cursor, statement, parameters, context,
+                       executemany):
+        started = connection.info.get("cart_api_query_started")
+        seconds = time.time() - started.pop() if started else 0.0
+        phase = current_phase() or OTHER_PHASE
+        statement = re.sub(r"\s+", " ", statement).strip()[:self.STATEMENT_LENGTH]
+        with self._lock:
+            count, total, slowest = self._phases.get(phase, (0, 0.0, []))
+            entry = (seconds, statement)
+            if len(slowest) < self.slowest:
+                heapq.heappush(slowest, entry)
+            elif entry > slowest[0]:
+                heapq.heapreplace(slowest, entry)
+            self._phases[phase] = (count + 1, total + seconds, slowest)
+            for capture in self._captures:
+                capture.append(statement)
+
+    def count(self, phase=None):
+        """ Statements recorded in a phase, or in all of them. """
+        with self._lock:
+            if phase is not None:
+                return self._phases.get(phase, (0, 0.0, []))[0]
+            return sum(count for count, _, _ in self._phases.values())
+
+    def phases(self):
+        """ List of per-phase records, most time spent first. """
+        with self._lock:
+            phases = [
+                {"phase": phase, "count": count, "seconds": total,
+                 "slowest": [{"seconds": seconds, "statement": statement}
+                             for seconds, statement in sorted(slowest, reverse=True)]}
+                for phase, (count, total, slowest) in self._phases.items()
+            ]
+        return sorted(phases, key=lambda p: p["seconds"], reverse=True)
+
+    def log_summary(self):
+        phases = self.phases()
+        if not phases:
+            return
+        logging.info("Queries: %s", ", ".join(
+            "%s %d in %.1fs" % (p["phase"], p["count"], p["seconds"]) for p in phases
+        ))
+        slowest = sorted(
+            ((entry["seconds"], p["phase"], entry["statement"])
+             for p in phases for entry in p["slowest"]),
+            reverse=True
+        )[:self.slowest]
+        for seconds, phase, statement in slowest:
+            logging.info("Slow query in %s, %.3fs: %s", phase, seconds, statement)
+
+    @contextmanager
+    def assert_max_queries(self, maximum):
+        """ Raise AssertionError if the block runs more than `maximum` statements. """
+        capture = []
+        with self._lock:
+            self._captures.append(capture)
+        try:
+            yield capture
+        finally:
+            with self._lock:
+                self._captures.remove(capture)
+        if len(capture) > maximum:
+            raise AssertionError("%d queries, expected at most %d:\n%s" % (
+                len(capture), maximum, "\n".join(capture)
+            ))
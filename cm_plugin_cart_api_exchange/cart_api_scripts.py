@@ -1,13 +1,35 @@
 from core.model.plugin_configuration import PluginConfiguration
 from core.model.library import Library
-from core.model.identifier import Identifier
+from core.model.identifier import Equivalency, Identifier
 from core.model.licensing import LicensePool
 from core.model.datasource import DataSource
-from core.model.collection import Collection, collections_libraries
+from core.model.collection import collections_libraries
 from core.scripts import Script
-from cart_api_operations import ExchangeApi
+from sqlalchemy import and_, func, or_, text
+from sqlalchemy.orm import Session, aliased
+from cart_api_cache import CollectionLicenseCache, IsbnCache
+from cart_api_items import Item
+from cart_api_metrics import InMemoryMetrics, JsonFileMetrics, MultiMetrics, StatsdMetrics
+from cart_api_operations import (
+    AdaptiveChunkSize,
+    AsyncExchangeApi,
+    SendCheckpoint,
+    TokenBucket,
+    chunk_dict,
+)
+from cart_api_queries import QueryRecorder
+from cart_api_spool import CartSpool, LicenseSpool
+from cart_api_state import CartDiff, decode_state, encode_state
 
+import calendar
+import datetime
+import itertools
 import logging
+import threading
+import time
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 
 KEY_USER = "user"
@@ -23,93 +45,486 @@ TRUE_VALUE = "true"
 FALSE_VALUE = "false"
 
 INTERNAL = "_internal."
+STATE_SUFFIX = "-state"
+CHECKPOINT_SUFFIX = "-checkpoint"
+WATERMARK_SUFFIX = "-watermark"
+
+EXPIRED = "expired"
+EXPIRING = "expiring"
+LONG_QUEUE = "long-queue"
+
+# cart key -> (kind of cart, restricted to the DPLA datasource)
+CARTS = {
+    KEY_EXPIRED_FROM_DPLA: (EXPIRED, True),
+    KEY_EXPIRED_FROM_ANY: (EXPIRED, False),
+    KEY_EXPIRING_FROM_DPLA: (EXPIRING, True),
+    KEY_EXPIRING_FROM_ANY: (EXPIRING, False),
+    KEY_LONG_QUEUE_FROM_DPLA: (LONG_QUEUE, True),
+    KEY_LONG_QUEUE_FROM_ANY: (LONG_QUEUE, False),
+}
+# Kinds of cart whose items may have no copies available. A removal sent
+# with quantity 0 would read as one of their items, so it is not sent.
+ZERO_COPY_KINDS = (EXPIRED, LONG_QUEUE)
+CART_KEYS = [
+    KEY_EXPIRED_FROM_DPLA,
+    KEY_EXPIRED_FROM_ANY,
+    KEY_EXPIRING_FROM_DPLA,
+    KEY_EXPIRING_FROM_ANY,
+    KEY_LONG_QUEUE_FROM_DPLA,
+    KEY_LONG_QUEUE_FROM_ANY,
+]
+
+LICENSE_COLUMNS = (
+    LicensePool.identifier_id,
+    LicensePool.licenses_available,
+    LicensePool.patrons_in_hold_queue,
+    LicensePool.data_source_id,
+)
+
+
+def cart_filter(kind):
+    """ SQL condition on LicensePool selecting the licenses of a kind of cart. """
+    if kind == EXPIRED:
+        return LicensePool.licenses_available == 0
+    if kind == EXPIRING:
+        return and_(LicensePool.licenses_available > 0,
+                    LicensePool.licenses_available <= 5)
+    if kind == LONG_QUEUE:
+        return LicensePool.patrons_in_hold_queue > 5
+    raise NotImplementedError
+
+
+def cart_matches(kind, license):
+    """ Python counterpart of `cart_filter` for an already loaded license row. """
+    if kind == EXPIRED:
+        return license.licenses_available == 0
+    if kind == EXPIRING:
+        return license.licenses_available is not None and \
+            0 < license.licenses_available <= 5
+    if kind == LONG_QUEUE:
+        return license.patrons_in_hold_queue is not None and \
+            license.patrons_in_hold_queue > 5
+    raise NotImplementedError
+
+
+def cart_predicate(cart_key, vendor_id):
+    """ (kind of cart, vendor id or None) selecting the licenses of a cart. """
+    kind, from_vendor = CARTS[cart_key]
+    return kind, vendor_id if from_vendor and vendor_id else None
+
+
+def enabled_cart_keys(values):
+    """ Keys of the carts enabled in the plugin values of a library. """
+    return [cart_key for cart_key in CART_KEYS if values.get(cart_key) == TRUE_VALUE]
+
+
+def unique_licenses(licenses):
+    """ Drop licenses without identifier and keep the last of consecutive
+    licenses sharing an identifier. """
+    previous = None
+    for license in licenses:
+        if not license.identifier_id:
+            continue
+        if previous is not None and previous.identifier_id != license.identifier_id:
+            yield previous
+        previous = license
+    if previous is not None:
+        yield previous
+
+
+def peek(iterable):
+    """ Iterator over `iterable`, or None when it is empty. """
+    iterator = iter(iterable)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return None
+    return itertools.chain([first], iterator)
+
+
+def epoch_seconds(value):
+    """ Seconds since the epoch of a datetime, naive ones being in UTC. """
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000.0
+
+
+class LibraryRun(object):
+    """ Timing and outcome of one library in a CartApiScript run. """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0
+        self.error = None
 
 
 class GetDatasourcesScript(Script):
     def get_datasources(self):
-        datasources = self._db.query(DataSource).all()
-        return [{"key": datasource.id, "label": datasource.name}
-                for datasource in datasources]
+        datasources = self._db.query(DataSource.id, DataSource.name).all()
+        return [{"key": datasource_id, "label": name}
+                for datasource_id, name in datasources]
 
 class CartApiScript(Script):
-    def __init__(self, _db=None):
+    # Number of chunks uploaded in parallel for each cart.
+    UPLOAD_WORKERS = 1
+    # Cart API requests per second allowed for each account, None for no limit.
+    REQUESTS_PER_SECOND = None
+    # Only send what changed since the last successful upload of each cart.
+    DELTA_SYNC = True
+    # Only scan the licenses changed since the last accepted upload of every
+    # cart, with a full scan every FULL_RESCAN_SECONDS or when more than
+    # INCREMENTAL_MAX_CHANGES identifiers changed. Requires DELTA_SYNC.
+    # The plugin runs every 5 days, so a full scan every 20 days leaves
+    # three incremental runs between them.
+    INCREMENTAL_SCAN = True
+    FULL_RESCAN_SECONDS = 20 * 24 * 60 * 60
+    INCREMENTAL_MAX_CHANGES = 50000
+    # Identifiers resolved to ISBNs per pair of queries.
+    ISBN_BATCH_SIZE = 1000
+    # Resolved ISBNs kept in memory, and for how many seconds.
+    ISBN_CACHE_SIZE = IsbnCache.MAX_SIZE
+    ISBN_CACHE_TTL = IsbnCache.TTL
+    # File keeping resolved ISBNs between runs, None to keep them in memory only.
+    ISBN_CACHE_PATH = None
+    # Libraries processed in parallel, each worker with its own DB session.
+    LIBRARY_WORKERS = 1
+    # Chunk size adjusted to the PATCH latency, within bounds.
+    ADAPTIVE_CHUNK_SIZE = True
+    CHUNK_SIZE = 1000
+    CHUNK_SIZE_MIN = 100
+    CHUNK_SIZE_MAX = 5000
+    CHUNK_TARGET_SECONDS = 10
+    # Directory where the items of each cart are spooled before being
+    # uploaded, so no transaction stays open during the uploads. None to
+    # stream them from the database.
+    SPOOL_DIR = None
+    # Keep the spools of accepted uploads, for debugging.
+    KEEP_SPOOLS = False
+    # Scan the collections shared by several libraries once per run.
+    SHARE_COLLECTION_LICENSES = True
+    # Carts created in parallel before the uploads start, and how long to
+    # wait for each before leaving it to its library run.
+    CART_CREATION_WORKERS = 4
+    CART_CREATION_TIMEOUT = 5 * 60
+    # Send PATCH bodies gzip compressed to the endpoints accepting it.
+    GZIP_UPLOADS = False
+    # Accepted chunks between two saves of an upload checkpoint.
+    CHECKPOINT_INTERVAL = 10
+    # Metrics outputs on top of the in-process aggregates logged after a run.
+    METRICS_JSON_PATH = None
+    METRICS_STATSD_HOST = None
+    METRICS_STATSD_PORT = 8125
+    # Log the statements, DB time and slowest queries of each phase of a run.
+    RECORD_QUERIES = True
+
+    def __init__(self, _db=None, upload_workers=None, requests_per_second=None,
+                 delta_sync=None, isbn_cache=None, library_workers=None, metrics=None,
+                 spool_dir=None, query_recorder=None):
         super(CartApiScript, self).__init__(_db=_db)
+        self.query_recorder = query_recorder
+        self.spool_dir = spool_dir or self.SPOOL_DIR
+        self._spooled = []
+        self.metrics = metrics or self._create_metrics()
+        self._metric_tags = {}
+        self._save_progress = None
+        self._changed_ids = None
+        self._next_watermark = None
+        self._saved_values = {}
+        self.license_cache = None
+        self.library_workers = library_workers or self.LIBRARY_WORKERS
+        self.isbn_cache = isbn_cache or IsbnCache(
+            self.ISBN_CACHE_SIZE, self.ISBN_CACHE_TTL, self.ISBN_CACHE_PATH
+        )
+        self.delta_sync = self.DELTA_SYNC if delta_sync is None else delta_sync
+        self.upload_workers = upload_workers or self.UPLOAD_WORKERS
+        self.requests_per_second = requests_per_second or self.REQUESTS_PER_SECOND
+
+    def _create_metrics(self):
+        sinks = [InMemoryMetrics()]
+        if self.METRICS_JSON_PATH:
+            sinks.append(JsonFileMetrics(self.METRICS_JSON_PATH))
+        if self.METRICS_STATSD_HOST:
+            sinks.append(StatsdMetrics(self.METRICS_STATSD_HOST, self.METRICS_STATSD_PORT))
+        return MultiMetrics(*sinks)
 
     def run(self, plugin_name):
-        plugin_model = PluginConfiguration()
-        internal_plugin_name = INTERNAL+plugin_name
+        own_recorder = self.query_recorder is None and self.RECORD_QUERIES
+        if own_recorder:
+            self.query_recorder = QueryRecorder(self._db.get_bind())
+        try:
+            return self._run(plugin_name)
+        finally:
+            if own_recorder:
+                self.query_recorder.detach()
+                self.query_recorder = None
 
+    def _run(self, plugin_name):
         libraries = self._db.query(Library).all()
 
-        for library in libraries:
-            values = PluginConfiguration().get_saved_values(
-                self._db, library.short_name, plugin_name
+        self.isbn_cache.load()
+        self.isbn_cache.validate(self._equivalencies_version())
+        with self.metrics.timed("config_load"):
+            self._saved_values = self._load_saved_values(plugin_name, libraries)
+        if self.SHARE_COLLECTION_LICENSES:
+            self.license_cache = self._create_license_cache(libraries)
+
+        # One pooled client per credential set, shared by all carts,
+        # libraries and workers using it.
+        self._exchange_apis = {}
+        self._exchange_apis_lock = threading.Lock()
+        started = time.time()
+        try:
+            self._create_missing_carts(plugin_name, libraries)
+            if self.library_workers > 1:
+                library_runs = self._run_libraries_in_workers(plugin_name, libraries)
+            else:
+                library_runs = [self._run_isolated(self, plugin_name, library)
+                                for library in libraries]
+        finally:
+            for exchange_api in self._exchange_apis.values():
+                exchange_api.close()
+            logging.info("ISBN cache: %d hits, %d misses, %d entries.",
+                         self.isbn_cache.hits, self.isbn_cache.misses, len(self.isbn_cache))
+            self.isbn_cache.save()
+
+        self._log_summary(library_runs, time.time() - started)
+        if self.query_recorder is not None:
+            self.query_recorder.log_summary()
+        self.metrics.flush()
+        return library_runs
+
+    def _run_libraries_in_workers(self, plugin_name, libraries):
+        bind = self._db.get_bind()
+        engine = getattr(bind, "engine", bind)
+        pool = ThreadPool(self.library_workers)
+        try:
+            return pool.map(
+                partial(self._run_library_worker, plugin_name, engine),
+                [library.id for library in libraries]
             )
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_library_worker(self, plugin_name, engine, library_id):
+        """ Run one library on a worker thread, with a session of its own. """
+        _db = Session(bind=engine)
+        try:
+            script = self._worker_script(_db)
+            library = _db.query(Library).get(library_id)
+            return self._run_isolated(script, plugin_name, library)
+        finally:
+            _db.close()
+
+    def _worker_script(self, _db):
+        script = self.__class__(
+            _db=_db, upload_workers=self.upload_workers,
+            requests_per_second=self.requests_per_second, delta_sync=self.delta_sync,
+            isbn_cache=self.isbn_cache, library_workers=1, metrics=self.metrics,
+            spool_dir=self.spool_dir,
+        )
+        script._exchange_apis = self._exchange_apis
+        script._exchange_apis_lock = self._exchange_apis_lock
+        script._saved_values = self._saved_values
+        script.license_cache = self.license_cache
+        return script
+
+    @staticmethod
+    def _run_isolated(script, plugin_name, library):
+        """ Run a library so that its failure doesn't stop the others. """
+        library_run = LibraryRun(library.name)
+        started = time.time()
+        try:
+            script._run_library(plugin_name, library)
+            script._db.commit()
+        except Exception as err:
+            logging.exception("Cannot run carts of library %s.", library.name)
+            library_run.error = err
+            script._db.rollback()
+            script.metrics.count("library_failed", 1, {"library": library.name})
+        if script.license_cache is not None:
+            script.license_cache.release(library.id)
+        library_run.seconds = time.time() - started
+        script.metrics.timing("library_run", library_run.seconds, {"library": library.name})
+        return library_run
+
+    def _log_summary(self, library_runs, seconds):
+        failed = [library_run for library_run in library_runs if library_run.error]
+        logging.info("Ran %d libraries in %.1fs. %d failed.",
+                     len(library_runs), seconds, len(failed))
+        for library_run in sorted(library_runs, key=lambda r: r.seconds, reverse=True):
+            if library_run.error:
+                logging.info("Library %s: %.1fs. Failed: %s", library_run.name,
+                             library_run.seconds, library_run.error)
+            else:
+                logging.info("Library %s: %.1fs.", library_run.name, library_run.seconds)
+
+        for sink in getattr(self.metrics, "sinks", [self.metrics]):
+            if isinstance(sink, InMemoryMetrics):
+                phases = {}
+                for timing in sink.timings():
+                    phases[timing["name"]] = phases.get(timing["name"], 0) + \
+                        timing["total_seconds"]
+                logging.info("Phases: %s", ", ".join(
+                    "%s %.1fs" % (name, seconds) for name, seconds
+                    in sorted(phases.items(), key=lambda p: p[1], reverse=True)
+                ))
+                break
+
+    def _run_library(self, plugin_name, library):
+        internal_plugin_name = INTERNAL+plugin_name
+        self._metric_tags = {"library": library.name}
+
+        with self.metrics.timed("config_load", self._metric_tags):
+            values, internal_values = self._get_saved_values(plugin_name, library)
+        # Values as stored, to skip writing them back unchanged
+        saved_values = dict(internal_values)
+        self._save_progress = partial(
+            self._save_internal_values, library, internal_plugin_name, internal_values,
+            saved_values, commit=True
+        )
+
+        user = None
+        user_config = values.get(KEY_USER)
+        if user_config:
+            user = user_config
+
+        pwd = None
+        pwd_config = values.get(KEY_PASSWORD)
+        if pwd_config:
+            pwd = pwd_config
+        exchange_api = self._get_exchange_api(user, pwd)
+
+        vendor = internal_values.get(KEY_DATASOURCE)
+        enabled_carts = enabled_cart_keys(values)
+        with self.metrics.timed("license_query", self._metric_tags):
+            self._scan_licenses(library, internal_values, enabled_carts, vendor)
+            licenses = self._split_licenses(library, enabled_carts, vendor)
+
+        try:
+            if KEY_EXPIRED_FROM_DPLA in licenses:
+                self._run_expired_items(
+                    exchange_api, internal_values, library, vendor=vendor,
+                    licenses=licenses[KEY_EXPIRED_FROM_DPLA]
+                )
+            if KEY_EXPIRED_FROM_ANY in licenses:
+                self._run_expired_items(
+                    exchange_api, internal_values, library,
+                    licenses=licenses[KEY_EXPIRED_FROM_ANY]
+                )
+            if KEY_EXPIRING_FROM_DPLA in licenses:
+                self._run_expiring_items(
+                    exchange_api, internal_values, library, vendor=vendor,
+                    licenses=licenses[KEY_EXPIRING_FROM_DPLA]
+                )
+            if KEY_EXPIRING_FROM_ANY in licenses:
+                self._run_expiring_items(
+                    exchange_api, internal_values, library,
+                    licenses=licenses[KEY_EXPIRING_FROM_ANY]
+                )
+            if KEY_LONG_QUEUE_FROM_DPLA in licenses:
+                self._run_long_queue_items(
+                    exchange_api, internal_values, library, vendor=vendor,
+                    licenses=licenses[KEY_LONG_QUEUE_FROM_DPLA]
+                )
+            if KEY_LONG_QUEUE_FROM_ANY in licenses:
+                self._run_long_queue_items(
+                    exchange_api, internal_values, library,
+                    licenses=licenses[KEY_LONG_QUEUE_FROM_ANY]
+                )
+        finally:
+            for rows in licenses.values():
+                if isinstance(rows, LicenseSpool):
+                    rows.close()
 
-            user = None
-            user_config = values.get(KEY_USER)
-            if user_config:
-                user = user_config
+        self._upload_spooled()
+        self._save_internal_values(library, internal_plugin_name, internal_values,
+                                   saved_values)
 
-            pwd = None
-            pwd_config = values.get(KEY_PASSWORD)
-            if pwd_config:
-                pwd = pwd_config
-            exchange_api = ExchangeApi(user, pwd)
+    def _load_saved_values(self, plugin_name, libraries):
+        """ Plugin and internal values of every library, with a single query.
+
+        Returns a dict of library id -> (values, internal values).
+        """
+        prefixes = (plugin_name + ".", INTERNAL + plugin_name + ".")
+        saved_values = dict((library.id, ({}, {})) for library in libraries)
+        rows = self._db.query(
+            PluginConfiguration.library_id, PluginConfiguration.key,
+            PluginConfiguration._value
+        ).filter(
+            or_(*[PluginConfiguration.key.like(prefix + "%") for prefix in prefixes])
+        )
+        for library_id, key, value in rows:
+            if library_id not in saved_values:
+                continue
+            # LIKE treats "_" as a wildcard, so check the prefix again
+            for values, prefix in zip(saved_values[library_id], prefixes):
+                if key.startswith(prefix):
+                    values[key[len(prefix):]] = value
+        return saved_values
+
+    def _get_saved_values(self, plugin_name, library):
+        if library.id in self._saved_values:
+            return self._saved_values[library.id]
+        plugin_model = PluginConfiguration()
+        return (
+            plugin_model.get_saved_values(self._db, library.short_name, plugin_name),
+            plugin_model.get_saved_values(self._db, library.short_name,
+                                          INTERNAL + plugin_name),
+        )
 
-            internal_values = plugin_model.get_saved_values(
-                self._db, library.short_name, internal_plugin_name
+    def _save_internal_values(self, library, internal_plugin_name, internal_values,
+                              saved_values, commit=False):
+        """ Write the internal values if they differ from `saved_values`. """
+        if internal_values == saved_values:
+            return
+        with self.metrics.timed("config_save", {"library": library.name}):
+            PluginConfiguration().save_values(
+                self._db, library.short_name, internal_plugin_name, internal_values
             )
+            if commit:
+                self._db.commit()
+        saved_values.clear()
+        saved_values.update(internal_values)
 
-            vendor = internal_values.get(KEY_DATASOURCE)
-            if values.get(KEY_EXPIRED_FROM_DPLA) and \
-                values[KEY_EXPIRED_FROM_DPLA] == TRUE_VALUE:
-                    self._run_expired_items(
-                        exchange_api, internal_values, library, vendor=vendor
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
-                    )
-            if values.get(KEY_EXPIRED_FROM_ANY) and \
-                values[KEY_EXPIRED_FROM_ANY] == TRUE_VALUE:
-                    self._run_expired_items(
-                        exchange_api, internal_values, library
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
-                    )
-            if values.get(KEY_EXPIRING_FROM_DPLA) and \
-                values[KEY_EXPIRING_FROM_DPLA] == TRUE_VALUE:
-                    self._run_expiring_items(
-                        exchange_api, internal_values, library, vendor=vendor
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
-                    )
-            if values.get(KEY_EXPIRING_FROM_ANY) and \
-                values[KEY_EXPIRING_FROM_ANY] == TRUE_VALUE:
-                    self._run_expiring_items(
-                        exchange_api, internal_values, library
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
-                    )
-            if values.get(KEY_LONG_QUEUE_FROM_DPLA) and \
-                values[KEY_LONG_QUEUE_FROM_DPLA] == TRUE_VALUE:
-                    self._run_long_queue_items(
-                        exchange_api, internal_values, library, vendor=vendor
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
-                    )
-            if values.get(KEY_LONG_QUEUE_FROM_ANY) and \
-                values[KEY_LONG_QUEUE_FROM_ANY] == TRUE_VALUE:
-                    self._run_long_queue_items(
-                        exchange_api, internal_values, library
-                    )
-                    plugin_model.save_values(
-                        self._db, library.short_name, internal_plugin_name, internal_values
+    def _equivalencies_version(self):
+        """ Cheap marker that changes when equivalencies are added, updated
+        or deleted.
+
+        The highest id is read from the primary key index. Rows updated or
+        deleted in place don't change it, so PostgreSQL's count of rows
+        written to the table, committed or in the current transaction, is
+        added: the statistics views are read, not the table.
+        """
+        max_id = self._db.query(func.max(Equivalency.id)).scalar()
+        writes = self._db.execute(text(
+            "SELECT s.n_tup_ins + s.n_tup_upd + s.n_tup_del"
+            " + x.n_tup_ins + x.n_tup_upd + x.n_tup_del"
+            " FROM pg_stat_user_tables s JOIN pg_stat_xact_user_tables x USING (relid)"
+            " WHERE s.relid = CAST(:table AS regclass)"
+        ), {"table": Equivalency.__tablename__}).scalar()
+        return "%s:%s" % (max_id, writes)
+
+    def _get_exchange_api(self, user, pwd):
+        key = (user, pwd)
+        with self._exchange_apis_lock:
+            if key not in self._exchange_apis:
+                rate_limiter = None
+                if self.requests_per_second:
+                    rate_limiter = TokenBucket(self.requests_per_second)
+                chunk_sizer = None
+                if self.ADAPTIVE_CHUNK_SIZE:
+                    chunk_sizer = AdaptiveChunkSize(
+                        self.CHUNK_SIZE, self.CHUNK_SIZE_MIN, self.CHUNK_SIZE_MAX,
+                        self.CHUNK_TARGET_SECONDS,
                     )
+                # Enough concurrent requests for every upload of the run
+                concurrency = max(self.CART_CREATION_WORKERS,
+                                  self.library_workers * self.upload_workers)
+                self._exchange_apis[key] = AsyncExchangeApi(
+                    user, pwd, concurrency=concurrency, max_workers=self.upload_workers,
+                    rate_limiter=rate_limiter, metrics=self.metrics, chunk_sizer=chunk_sizer,
+                    gzip=self.GZIP_UPLOADS,
+                )
+            return self._exchange_apis[key]
 
     def _get_or_create_cart(self, exchange_api, library_name, cart_key, internal_values):
         cart_name = library_name + " " + cart_key
@@ -118,29 +533,120 @@ class CartApiScript(Script):
             cart_url = cart_url
         else:
             cart_url = exchange_api.create_cart(cart_name)
-            internal_values[cart_key] = cart_url
-            try:
-                self._db.commit()
-            except Exception as ex:
-                self._db.rollback()
+            self._set_cart_url(internal_values, cart_key, cart_url)
         return cart_name, cart_url
 
-    def _get_licenses_query(self, library, vendor_id):
-        target_collections = self._db.query(
-            Collection,
-            collections_libraries
-        ).filter(
-            Collection.id == collections_libraries.columns.collection_id
+    @staticmethod
+    def _set_cart_url(internal_values, cart_key, cart_url):
+        internal_values[cart_key] = cart_url
+        # A new cart is empty, whatever was sent to a previous one.
+        internal_values.pop(cart_key + STATE_SUFFIX, None)
+        internal_values.pop(cart_key + CHECKPOINT_SUFFIX, None)
+        internal_values.pop(cart_key + WATERMARK_SUFFIX, None)
+
+    def _create_missing_carts(self, plugin_name, libraries):
+        """ Create the enabled carts that have no URL yet, for every library.
+
+        Carts are created in the background by the Exchange clients, at
+        least CART_CREATION_WORKERS at a time per account, and their URLs
+        saved with one commit before any item is uploaded. A cart that
+        cannot be created within CART_CREATION_TIMEOUT seconds, or whose
+        URL cannot be saved, is created again when its library runs.
+        """
+        missing = []
+        for library in libraries:
+            values, internal_values = self._get_saved_values(plugin_name, library)
+            for cart_key in enabled_cart_keys(values):
+                if not internal_values.get(cart_key):
+                    exchange_api = self._get_exchange_api(
+                        values.get(KEY_USER) or None, values.get(KEY_PASSWORD) or None
+                    )
+                    missing.append((library, internal_values, cart_key, exchange_api))
+        if not missing:
+            return
+
+        cart_urls = []
+        with self.metrics.timed("cart_creation"):
+            pending = [exchange_api.create_cart_async(library.name + " " + cart_key)
+                       for library, _, cart_key, exchange_api in missing]
+            for (library, _, cart_key, _), call in zip(missing, pending):
+                try:
+                    cart_urls.append(call.get(self.CART_CREATION_TIMEOUT))
+                except Exception as err:
+                    logging.warning("Cannot create cart %s of library %s. %s",
+                                    cart_key, library.name, str(err) or type(err).__name__)
+                    cart_urls.append(None)
+
+        created = {}
+        for (library, internal_values, cart_key, _), cart_url in zip(missing, cart_urls):
+            if cart_url:
+                if library.id not in created:
+                    created[library.id] = (library, internal_values, dict(internal_values))
+                self._set_cart_url(internal_values, cart_key, cart_url)
+        logging.info("Created %d of %d missing carts.",
+                     len([cart_url for cart_url in cart_urls if cart_url]), len(missing))
+
+        try:
+            with self.metrics.timed("config_save"):
+                for library, internal_values, _ in created.values():
+                    PluginConfiguration().save_values(
+                        self._db, library.short_name, INTERNAL + plugin_name, internal_values
+                    )
+                self._db.commit()
+        except Exception:
+            logging.exception("Cannot save the URLs of the created carts.")
+            self._db.rollback()
+            # Carts are created again when their library runs
+            for _, internal_values, previous_values in created.values():
+                internal_values.clear()
+                internal_values.update(previous_values)
+
+    def _create_license_cache(self, libraries):
+        """ CollectionLicenseCache of the libraries with carts enabled that need
+        a full scan, or None when they share no collection. """
+        library_ids = set()
+        for library in libraries:
+            values, internal_values = self._saved_values.get(library.id, ({}, {}))
+            cart_keys = enabled_cart_keys(values)
+            if cart_keys and self._scan_watermark(
+                    internal_values, cart_keys, internal_values.get(KEY_DATASOURCE)) is None:
+                library_ids.add(library.id)
+        library_collections = {}
+        for library_id, collection_id in self._db.query(
+            collections_libraries.columns.library_id,
+            collections_libraries.columns.collection_id,
+        ):
+            if library_id in library_ids:
+                library_collections.setdefault(library_id, []).append(collection_id)
+
+        license_cache = CollectionLicenseCache(library_collections)
+        shared = [collection_id for collection_id in set(itertools.chain.from_iterable(
+            library_collections.values())) if license_cache.is_shared(collection_id)]
+        if not shared:
+            return None
+        logging.info("%d collections are shared by several libraries.", len(shared))
+        return license_cache
+
+    def _library_collections(self, library):
+        return self._db.query(
+            collections_libraries.columns.collection_id
         ).filter(
             collections_libraries.columns.library_id == library.id
-        ).all()
+        )
 
+    def _get_licenses_query(self, library, vendor_id, *columns):
+        return self._get_collection_licenses_query(
+            self._library_collections(library), vendor_id, *columns
+        )
+
+    def _get_collection_licenses_query(self, collections, vendor_id, *columns):
+        """ Licenses of `collections`, a list of ids or a query selecting them. """
         licenses_query = self._db.query(
-            LicensePool
+            *(columns or [LicensePool])
         ).filter(
             LicensePool.open_access.is_(False)
         ).filter(
-            LicensePool.collection_id.in_([t[0].id for t in target_collections])
+            LicensePool.collection_id.in_(collections)
         )
 
         if vendor_id:
@@ -149,28 +655,316 @@ class CartApiScript(Script):
             )
 
         return licenses_query
-        
+
+    def _scan_licenses(self, library, internal_values, cart_keys, vendor):
+        """ Decide between a full and an incremental scan of the library.
+
+        Sets `_changed_ids` to the identifier ids to rescan, or None for a
+        full scan, and `_next_watermark` to what the carts record once
+        their changes are accepted.
+        """
+        self._changed_ids = None
+        self._next_watermark = None
+        if not self.INCREMENTAL_SCAN or not self.delta_sync or not cart_keys:
+            return
+        watermark = self._scan_watermark(internal_values, cart_keys, vendor)
+        # Read before the changes, so nothing changed during the scan is missed
+        last_change = self._last_license_change(library)
+        if watermark is not None:
+            changed_ids = self._changed_identifiers(library, watermark["last_change"])
+            if len(changed_ids) <= self.INCREMENTAL_MAX_CHANGES:
+                logging.info("Scanning %d changed identifiers.", len(changed_ids))
+                self._changed_ids = changed_ids
+            else:
+                logging.info("More than %d identifiers changed, scanning everything.",
+                             self.INCREMENTAL_MAX_CHANGES)
+        full_scan = watermark["full_scan"] if self._changed_ids is not None else time.time()
+        if last_change is not None:
+            self._next_watermark = encode_state({
+                "last_change": last_change, "full_scan": full_scan, "vendor": vendor,
+            })
+
+    def _scan_watermark(self, internal_values, cart_keys, vendor):
+        """ The oldest watermark of the carts, or None when they need a full scan. """
+        if not self.INCREMENTAL_SCAN or not self.delta_sync:
+            return None
+        watermarks = []
+        for cart_key in cart_keys:
+            watermark = decode_state(internal_values.get(cart_key + WATERMARK_SUFFIX))
+            if not watermark or cart_key + STATE_SUFFIX not in internal_values or \
+                    watermark.get("vendor") != vendor:
+                return None
+            watermarks.append(watermark)
+        if not watermarks:
+            return None
+        watermark = min(watermarks, key=lambda w: w["last_change"])
+        if time.time() - min(w["full_scan"] for w in watermarks) > self.FULL_RESCAN_SECONDS:
+            return None
+        return watermark
+
+    def _last_license_change(self, library):
+        """ Time of the last availability or hold change in the library's
+        collections, in seconds since the epoch. """
+        last_change = self._db.query(
+            func.max(LicensePool.last_checked)
+        ).filter(
+            LicensePool.collection_id.in_(self._library_collections(library))
+        ).scalar()
+        return epoch_seconds(last_change) if last_change is not None else None
+
+    def _changed_identifiers(self, library, since):
+        """ Ids of the identifiers with a license changed at or after `since`.
+
+        Open access licenses are included, so a license that became open
+        access leaves its carts. No more than INCREMENTAL_MAX_CHANGES + 1
+        ids are read, enough to tell that a full scan is cheaper.
+        """
+        return [identifier_id for identifier_id, in
+                self._get_changed_identifiers_query(library, since).limit(
+                    self.INCREMENTAL_MAX_CHANGES + 1
+                )]
+
+    def _get_changed_identifiers_query(self, library, since):
+        return self._db.query(
+            LicensePool.identifier_id
+        ).filter(
+            LicensePool.collection_id.in_(self._library_collections(library))
+        ).filter(
+            # A second of overlap covers the rounding of the stored watermark.
+            # Comparing the column itself lets PostgreSQL use an index on it.
+            LicensePool.last_checked >= datetime.datetime.utcfromtimestamp(since - 1)
+        ).filter(
+            LicensePool.identifier_id.isnot(None)
+        ).distinct()
+
+    def _split_licenses(self, library, cart_keys, vendor_id):
+        """ License rows of each cart of a library, to be read as the carts run.
+
+        The rows of a single cart are left to `_stream_licenses`, as None.
+        Several carts are classified with a single query, and each cart's
+        rows go to a LicenseSpool when there is a spool directory, so they
+        are read back from disk instead of kept. The collections shared
+        with other libraries stay in the license cache during a run.
+        """
+        cached = self._changed_ids is None and self.license_cache is not None and \
+            self.license_cache.collections(library.id) is not None
+        if len(cart_keys) == 1 and not cached:
+            return {cart_keys[0]: None}
+        sink = partial(LicenseSpool, self.spool_dir) if self.spool_dir else list
+        return self._classify_licenses(library, cart_keys, vendor_id,
+                                       identifier_ids=self._changed_ids, sink=sink)
+
+    def _stream_licenses(self, library, vendor_id, kind, identifier_ids=None):
+        """ License rows of one kind of cart, fetched ISBN_BATCH_SIZE at a time.
+        `identifier_ids` restricts them to some identifiers. """
+        if identifier_ids is not None and not identifier_ids:
+            return []
+        licenses_query = self._get_licenses_query(
+            library, vendor_id, *LICENSE_COLUMNS
+        )
+        if identifier_ids is not None:
+            licenses_query = licenses_query.filter(
+                LicensePool.identifier_id.in_(identifier_ids)
+            )
+        return licenses_query.filter(
+            cart_filter(kind)
+        ).order_by(
+            LicensePool.identifier_id
+        ).yield_per(self.ISBN_BATCH_SIZE)
+
+    def _classify_licenses(self, library, cart_keys, vendor_id, collections=None,
+                           identifier_ids=None, sink=list):
+        """ Split the licenses of a library among carts with a single query.
+
+        Only the columns the carts need are loaded, and each row is checked
+        against every cart in `cart_keys` in one pass over the result.
+        Returns a dict of cart key -> license rows ordered by identifier id,
+        appended as they are read to a new `sink()` per cart: a list, or a
+        LicenseSpool to keep them on disk. Shared collections always give
+        lists, the license cache holds them.
+
+        During a run, the collections shared with other libraries go
+        through the license cache instead. `collections` restricts the
+        query to some collection ids of the library, and `identifier_ids`
+        to some identifiers.
+        """
+        if not cart_keys:
+            return {}
+        if identifier_ids is not None and not identifier_ids:
+            return dict((cart_key, []) for cart_key in cart_keys)
+        vendor_id = int(vendor_id) if vendor_id else None
+        if collections is None and identifier_ids is None and self.license_cache is not None:
+            library_collections = self.license_cache.collections(library.id)
+            if library_collections is not None:
+                return self._classify_shared_licenses(library, cart_keys, vendor_id,
+                                                      library_collections)
+        carts = [(cart_key, ) + CARTS[cart_key] for cart_key in cart_keys]
+        licenses_query = self._get_classify_query(
+            library, cart_keys, vendor_id, collections, identifier_ids
+        ).yield_per(self.ISBN_BATCH_SIZE)
+
+        licenses = dict((cart_key, sink()) for cart_key in cart_keys)
+        for license in licenses_query:
+            for cart_key, kind, from_vendor in carts:
+                if from_vendor and vendor_id and license.data_source_id != vendor_id:
+                    continue
+                if cart_matches(kind, license):
+                    licenses[cart_key].append(license)
+        return licenses
+
+    def _get_classify_query(self, library, cart_keys, vendor_id, collections=None,
+                            identifier_ids=None):
+        """ Query of `_classify_licenses`: the license rows matching any of the carts. """
+        carts = [CARTS[cart_key] for cart_key in cart_keys]
+        only_vendor = vendor_id and all(from_vendor for _, from_vendor in carts)
+
+        if collections is None:
+            licenses_query = self._get_licenses_query(
+                library, vendor_id if only_vendor else None, *LICENSE_COLUMNS
+            )
+        else:
+            licenses_query = self._get_collection_licenses_query(
+                collections, vendor_id if only_vendor else None, *LICENSE_COLUMNS
+            )
+        if identifier_ids is not None:
+            licenses_query = licenses_query.filter(
+                LicensePool.identifier_id.in_(identifier_ids)
+            )
+        return licenses_query.filter(
+            or_(*[cart_filter(kind) for kind in set(kind for kind, _ in carts)])
+        ).order_by(
+            LicensePool.identifier_id
+        )
+
+    def _classify_shared_licenses(self, library, cart_keys, vendor_id, collections):
+        """ `_classify_licenses` composing the library's carts from the license
+        cache for shared collections and one query for its own ones.
+
+        The library's references to its collections are released afterwards.
+        """
+        cache = self.license_cache
+        own = []
+        parts = []
+        try:
+            for collection_id in collections:
+                if not cache.is_shared(collection_id):
+                    own.append(collection_id)
+                    continue
+                with cache.lock(collection_id):
+                    rows = dict(
+                        (cart_key, cache.get(collection_id, cart_predicate(cart_key, vendor_id)))
+                        for cart_key in cart_keys
+                    )
+                    missing = [cart_key for cart_key in cart_keys if rows[cart_key] is None]
+                    if missing:
+                        classified = self._classify_licenses(library, missing, vendor_id,
+                                                             collections=[collection_id])
+                        for cart_key in missing:
+                            cache.set(collection_id, cart_predicate(cart_key, vendor_id),
+                                      classified[cart_key])
+                            rows[cart_key] = classified[cart_key]
+                parts.append(rows)
+            if own:
+                parts.append(self._classify_licenses(library, cart_keys, vendor_id,
+                                                     collections=own))
+        finally:
+            cache.release(library.id)
+
+        if len(parts) == 1:
+            return parts[0]
+        licenses = {}
+        for cart_key in cart_keys:
+            # Licenses without identifier are dropped later, sort them first
+            licenses[cart_key] = sorted(
+                itertools.chain.from_iterable(part[cart_key] for part in parts),
+                key=lambda license: license.identifier_id or 0
+            )
+        return licenses
+
     def _get_items_from_licenses(self, licenses):
-        items = {}
-        for license in licenses:
-            if license.identifier_id:
-                items[license.identifier_id] = {"copies": license.licenses_available}
+        """ Yield (identifier id, item) pairs for licenses ordered by identifier id.
 
-        identifiers = self._db.query(
-            Identifier
+        Licenses are consumed ISBN_BATCH_SIZE at a time, so ISBNs are
+        resolved for one batch at a time. When several licenses share an
+        identifier, the last one wins.
+        """
+        for batch in chunk_dict(unique_licenses(licenses), self.ISBN_BATCH_SIZE):
+            isbns = self._resolve_isbns([license.identifier_id for license in batch])
+            for license in batch:
+                yield license.identifier_id, Item(
+                    isbns.get(license.identifier_id, ""), license.licenses_available
+                )
+
+    def _resolve_isbns(self, identifier_ids):
+        """ Map identifier ids to the ISBN to send to the cart.
+
+        ISBNs map to themselves. Other identifiers map to the strongest ISBN
+        they are equivalent to, or to themselves when there is none. Ids not
+        in the ISBN cache are resolved with two queries per ISBN_BATCH_SIZE
+        identifiers.
+        """
+        isbns = {}
+        missing = []
+        for identifier_id in identifier_ids:
+            isbn = self.isbn_cache.get(identifier_id)
+            if isbn is None:
+                missing.append(identifier_id)
+            else:
+                isbns[identifier_id] = isbn
+
+        with self.metrics.timed("isbn_resolution", self._metric_tags):
+            resolved = self._query_isbns(missing)
+        for identifier_id, isbn in resolved.items():
+            self.isbn_cache.set(identifier_id, isbn)
+        isbns.update(resolved)
+        return isbns
+
+    def _query_isbns(self, identifier_ids):
+        isbns = {}
+        for n in range(0, len(identifier_ids), self.ISBN_BATCH_SIZE):
+            batch = identifier_ids[n:n + self.ISBN_BATCH_SIZE]
+
+            not_isbn = []
+            for identifier_id, identifier_type, identifier in \
+                    self._get_identifiers_query(batch):
+                isbns[identifier_id] = identifier
+                if identifier_type != Identifier.ISBN:
+                    not_isbn.append(identifier_id)
+
+            if not not_isbn:
+                continue
+
+            resolved = set()
+            for identifier_id, isbn in self._get_equivalent_isbns_query(not_isbn):
+                if identifier_id not in resolved:
+                    resolved.add(identifier_id)
+                    isbns[identifier_id] = isbn
+        return isbns
+
+    def _get_identifiers_query(self, identifier_ids):
+        return self._db.query(
+            Identifier.id, Identifier.type, Identifier.identifier
+        ).filter(
+            Identifier.id.in_(identifier_ids)
+        )
+
+    def _get_equivalent_isbns_query(self, identifier_ids):
+        """ (input id, ISBN) of the equivalencies of `identifier_ids`, strongest first. """
+        isbn_output = aliased(Identifier)
+        return self._db.query(
+            Equivalency.input_id, isbn_output.identifier
+        ).join(
+            isbn_output, Equivalency.output_id == isbn_output.id
+        ).filter(
+            Equivalency.input_id.in_(identifier_ids)
         ).filter(
-            Identifier.id.in_([l.identifier_id for l in licenses])
-        ).all()
-
-        for identifier in identifiers:
-            items[identifier.id]["identifier"] = identifier.identifier
-            if identifier.type != "ISBN":
-                for equivalent in identifier.equivalencies:
-                    equivalent.output.type != "ISBN"
-                    items[identifier.id]["identifier"] = equivalent.output.identifier
-        return items
-
-    def _run_expired_items(self, exchange_api, internal_values, library, vendor=None):
+            isbn_output.type == Identifier.ISBN
+        ).order_by(
+            Equivalency.input_id, Equivalency.strength.desc().nullslast()
+        )
+
+    def _run_expired_items(self, exchange_api, internal_values, library, vendor=None,
+                           licenses=None):
         logging.info("Running expired queue. Library: %s. vendor %s", library.name, vendor)
         if vendor:
             cart_key = KEY_EXPIRED_FROM_DPLA
@@ -179,23 +973,20 @@ class CartApiScript(Script):
         else:
             raise NotImplementedError
 
+        self._metric_tags = {"library": library.name, "cart": cart_key}
         cart_name, cart_url = self._get_or_create_cart(exchange_api, library.name,
                                                        cart_key, internal_values)
 
-        licenses_query = self._get_licenses_query(library, vendor)
-        licenses_query = licenses_query.filter(
-            LicensePool.licenses_available == 0,
-        )
-        licenses = licenses_query.all()
+        if licenses is None:
+            licenses = self._stream_licenses(library, vendor, EXPIRED, self._changed_ids)
 
         items = self._get_items_from_licenses(licenses)
 
-        if items:
-            exchange_api.send_items(cart_url, items, cart_name)
-        else:
-            logging.warning("No items found.")
+        self._send_cart_items(exchange_api, internal_values, library, cart_key, cart_url,
+                              cart_name, items)
 
-    def _run_expiring_items(self, exchange_api, internal_values, library, vendor=None):
+    def _run_expiring_items(self, exchange_api, internal_values, library, vendor=None,
+                            licenses=None):
         logging.info("Running expiring queue. Library: %s. vendor %s", library.name, vendor)
         if vendor:
             cart_key = KEY_EXPIRING_FROM_DPLA
@@ -204,25 +995,20 @@ class CartApiScript(Script):
         else:
             raise NotImplementedError
 
+        self._metric_tags = {"library": library.name, "cart": cart_key}
         cart_name, cart_url = self._get_or_create_cart(exchange_api, library.name,
                                                        cart_key, internal_values)
 
-        licenses_query = self._get_licenses_query(library, vendor)
-        licenses_query = licenses_query.filter(
-            LicensePool.licenses_available > 0,
-        ).filter(
-            LicensePool.licenses_available <= 5,
-        )
-        licenses = licenses_query.all()
+        if licenses is None:
+            licenses = self._stream_licenses(library, vendor, EXPIRING, self._changed_ids)
 
         items = self._get_items_from_licenses(licenses)
 
-        if items:
-            exchange_api.send_items(cart_url, items, cart_name)
-        else:
-            logging.warning("No items found.")
+        self._send_cart_items(exchange_api, internal_values, library, cart_key, cart_url,
+                              cart_name, items)
 
-    def _run_long_queue_items(self, exchange_api, internal_values, library, vendor=None):
+    def _run_long_queue_items(self, exchange_api, internal_values, library, vendor=None,
+                              licenses=None):
         logging.info("Running long queue. Library: %s. vendor %s", library.name, vendor)
         if vendor:
             cart_key = KEY_LONG_QUEUE_FROM_DPLA
@@ -231,18 +1017,169 @@ class CartApiScript(Script):
         else:
             raise NotImplementedError
 
+        self._metric_tags = {"library": library.name, "cart": cart_key}
         cart_name, cart_url = self._get_or_create_cart(exchange_api, library.name,
                                                        cart_key, internal_values)
 
-        licenses_query = self._get_licenses_query(library, vendor)
-        licenses_query = licenses_query.filter(
-            LicensePool.patrons_in_hold_queue > 5,
-        )
-        licenses = licenses_query.all()
+        if licenses is None:
+            licenses = self._stream_licenses(library, vendor, LONG_QUEUE, self._changed_ids)
 
         items = self._get_items_from_licenses(licenses)
 
-        if items:
-            exchange_api.send_items(cart_url, items, cart_name)
+        self._send_cart_items(exchange_api, internal_values, library, cart_key, cart_url,
+                              cart_name, items)
+
+    def _send_cart_items(self, exchange_api, internal_values, library, cart_key, cart_url,
+                         cart_name, items):
+        """ Stream `items` to the cart, or only what changed since the last run.
+
+        `items` is an iterable of (identifier id, item) pairs. The
+        fingerprint of the last fully accepted upload is kept in the
+        internal values, and only replaced when every item was read and
+        accepted.
+
+        Until then a checkpoint of the accepted chunks is saved every
+        CHECKPOINT_INTERVAL chunks, so a run that died halfway resumes
+        after them as long as the items to send are the same.
+
+        With a spool directory the items are written to a CartSpool
+        instead, and uploaded once every cart of the library is extracted.
+        """
+        diff = None
+        state_key = cart_key + STATE_SUFFIX
+        previous_state = decode_state(internal_values.get(state_key))
+        if self.delta_sync:
+            diff = CartDiff(previous_state,
+                            send_removals=CARTS[cart_key][0] not in ZERO_COPY_KINDS)
+            if self._changed_ids is not None and state_key in internal_values:
+                items = diff.updates(items, self._changed_ids)
+            else:
+                items = diff.changes(items)
         else:
-            logging.warning("No items found.")
+            items = (item for _, item in items)
+
+        items = peek(items)
+        if items is None:
+            if previous_state and self.delta_sync:
+                logging.info("No changes since last run.")
+            else:
+                logging.warning("No items found.")
+            if diff is not None and self._next_watermark:
+                internal_values[state_key] = encode_state(diff.state)
+                internal_values[cart_key + WATERMARK_SUFFIX] = self._next_watermark
+            return
+
+        def new_state():
+            if diff is not None and diff.exhausted:
+                return encode_state(diff.state)
+
+        if self.spool_dir:
+            spool = CartSpool.for_cart(self.spool_dir, library.id, cart_key)
+            with self.metrics.timed("spool_write", self._metric_tags):
+                count = spool.write({
+                    "library": self._metric_tags.get("library"), "cart_key": cart_key,
+                    "cart_name": cart_name, "cart_url": cart_url, "user": exchange_api.user,
+                    "watermark": self._next_watermark,
+                }, items, new_state)
+            logging.info("Spooled %d items to %s.", count, spool.path)
+            self._spooled.append((exchange_api, internal_values, spool))
+            return
+
+        self._upload_cart_items(exchange_api, internal_values, cart_key, cart_url, cart_name,
+                                items, new_state, self._next_watermark)
+
+    def _upload_cart_items(self, exchange_api, internal_values, cart_key, cart_url, cart_name,
+                           items, new_state, watermark=None):
+        """ Send `items` and, if all were accepted, record the state from `new_state()`
+        and the scan `watermark`.
+
+        Returns the SendResult.
+        """
+        checkpoint_key = cart_key + CHECKPOINT_SUFFIX
+        previous_checkpoint = decode_state(internal_values.get(checkpoint_key))
+        if previous_checkpoint.get("url") != cart_url:
+            previous_checkpoint = {}
+        checkpoint = SendCheckpoint(
+            previous_checkpoint.get("chunks"), previous_checkpoint.get("sizes"),
+            on_progress=partial(self._save_checkpoint, internal_values, checkpoint_key,
+                                cart_url),
+            interval=self.CHECKPOINT_INTERVAL,
+        )
+
+        result = exchange_api.send_items(cart_url, items, cart_name,
+                                         metric_tags=self._metric_tags,
+                                         checkpoint=checkpoint)
+        state = new_state()
+        if state is not None and result.total_with_error == 0:
+            internal_values[cart_key + STATE_SUFFIX] = state
+            if watermark:
+                internal_values[cart_key + WATERMARK_SUFFIX] = watermark
+        if result.total_with_error == 0 or not checkpoint.chunk_hashes:
+            internal_values.pop(checkpoint_key, None)
+        else:
+            self._save_checkpoint(internal_values, checkpoint_key, cart_url, checkpoint,
+                                  persist=False)
+        return result
+
+    def _upload_spool(self, exchange_api, internal_values, spool):
+        """ Upload a spool written by `_send_cart_items`, removing it once accepted. """
+        header = spool.header or spool.read_header()
+        if header is None:
+            return None
+        self._metric_tags = {"library": header["library"], "cart": header["cart_key"]}
+        result = self._upload_cart_items(
+            exchange_api, internal_values, header["cart_key"], header["cart_url"],
+            header["cart_name"], spool.items(), lambda: spool.state, header.get("watermark")
+        )
+        if result.total_with_error == 0 and not self.KEEP_SPOOLS:
+            spool.remove()
+        return result
+
+    def _upload_spooled(self):
+        """ Upload what the library spooled, after ending its transaction. """
+        if not self._spooled:
+            return
+        self._db.commit()
+        spooled, self._spooled = self._spooled, []
+        for exchange_api, internal_values, spool in spooled:
+            self._upload_spool(exchange_api, internal_values, spool)
+
+    def replay_spools(self, credentials):
+        """ Upload the spools left in SPOOL_DIR without using the database.
+
+        `credentials` maps Exchange users to their password; spools of
+        other users are skipped. Cart states and checkpoints can't be
+        recorded, so the next regular run sends these changes again.
+        Returns a list of (spool path, SendResult or None).
+        """
+        if not self.spool_dir:
+            raise ValueError("No spool directory to replay, set SPOOL_DIR or spool_dir.")
+        self._exchange_apis = {}
+        self._exchange_apis_lock = threading.Lock()
+        results = []
+        try:
+            for spool in CartSpool.find(self.spool_dir):
+                header = spool.read_header()
+                if header is None:
+                    continue
+                if header.get("user") not in credentials:
+                    logging.warning("No credentials for spool %s.", spool.path)
+                    continue
+                logging.info("Replaying %s.", spool.path)
+                exchange_api = self._get_exchange_api(header["user"],
+                                                      credentials[header["user"]])
+                results.append((spool.path, self._upload_spool(exchange_api, {}, spool)))
+        finally:
+            for exchange_api in self._exchange_apis.values():
+                exchange_api.close()
+        self.metrics.flush()
+        return results
+
+    def _save_checkpoint(self, internal_values, checkpoint_key, cart_url, checkpoint,
+                         persist=True):
+        internal_values[checkpoint_key] = encode_state({
+            "url": cart_url, "chunks": checkpoint.chunk_hashes,
+            "sizes": checkpoint.chunk_sizes,
+        })
+        if persist and self._save_progress:
+            self._save_progress()
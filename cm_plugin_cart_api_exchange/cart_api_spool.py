@@ -0,0 +1,135 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+
+from collections import namedtuple
+
+from cart_api_items import Item
+
+
+# The license columns the carts are built from
+LicenseRow = namedtuple("LicenseRow", [
+    "identifier_id", "licenses_available", "patrons_in_hold_queue", "data_source_id",
+])
+
+
+class CartSpool(object):
+    """ Append-only NDJSON file with the items to upload to one cart.
+
+    The first line is a header describing the cart, then comes one
+    [identifier, copies] line per item and, last, {"state": ...} with the
+    cart state to record once the items are accepted. Files are written
+    under a temporary name and renamed when complete, so a spool found on
+    disk is always whole.
+    """
+    VERSION = 1
+    EXTENSION = ".ndjson"
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.state = None
+
+    @classmethod
+    def for_cart(cls, directory, library_id, cart_key):
+        """ Spool of a library's cart. Cart names are not used, since they
+        may not be unique once made safe for a file name. """
+        file_name = "%s-%s%s" % (library_id, cart_key, cls.EXTENSION)
+        return cls(os.path.join(directory, file_name))
+
+    @classmethod
+    def find(cls, directory):
+        """ Spools of `directory`, in name order. """
+        paths = glob.glob(os.path.join(directory, "*" + cls.EXTENSION))
+        return [cls(path) for path in sorted(paths)]
+
+    def write(self, header, items, state):
+        """ Spool `items`, then the state returned by `state()`. Returns the item count. """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        count = 0
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as spool_file:
+                header = dict(header, version=self.VERSION)
+                spool_file.write(json.dumps(header, sort_keys=True) + "\n")
+                for item in items:
+                    spool_file.write(json.dumps([item.identifier, item.copies],
+                                                separators=(",", ":")) + "\n")
+                    count += 1
+                self.state = state()
+                spool_file.write(json.dumps({"state": self.state}) + "\n")
+            os.rename(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.header = header
+        return count
+
+    def read_header(self):
+        """ The header of the spool, or None if it cannot be read. """
+        try:
+            with open(self.path) as spool_file:
+                header = json.loads(spool_file.readline())
+        except (IOError, ValueError) as err:
+            logging.warning("Cannot read spool %s. %s", self.path, err)
+            return None
+        if not isinstance(header, dict) or header.get("version") != self.VERSION:
+            logging.warning("Unknown spool format in %s.", self.path)
+            return None
+        self.header = header
+        return header
+
+    def items(self):
+        """ Yield the spooled Items. `state` is set once they are all read. """
+        self.state = None
+        with open(self.path) as spool_file:
+            spool_file.readline()
+            for line in spool_file:
+                entry = json.loads(line)
+                if isinstance(entry, dict):
+                    self.state = entry.get("state")
+                    return
+                yield Item(entry[0], entry[1])
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError as err:
+            logging.warning("Cannot remove spool %s. %s", self.path, err)
+
+
+class LicenseSpool(object):
+    """ Temporary file holding the license rows of one cart, so the rows of
+    every cart can be read from a single query without keeping them.
+
+    Rows are added with `append` and read back in the same order by
+    iterating. The file is removed when the spool is closed.
+    """
+    SUFFIX = ".rows"
+
+    def __init__(self, directory=None):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = tempfile.TemporaryFile(mode="w+", dir=directory, suffix=self.SUFFIX)
+        self.count = 0
+
+    def append(self, license):
+        self._file.write(json.dumps([getattr(license, field) for field in LicenseRow._fields],
+                                    separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def __iter__(self):
+        self._file.flush()
+        self._file.seek(0)
+        for line in iter(self._file.readline, ""):
+            yield LicenseRow(*json.loads(line))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._file.close()
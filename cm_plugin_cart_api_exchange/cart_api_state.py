@@ -0,0 +1,83 @@
+import base64
+import json
+import zlib
+
+from cart_api_items import Item
+
+
+def encode_state(state):
+    """ Serialize a cart state into a compact string for PluginConfiguration. """
+    as_json = json.dumps(state, separators=(",", ":"), sort_keys=True)
+    return base64.b64encode(zlib.compress(as_json.encode("utf-8"))).decode("ascii")
+
+
+def decode_state(value):
+    """ Inverse of `encode_state`. Missing or unreadable values give an empty state. """
+    if not value:
+        return {}
+    try:
+        return json.loads(zlib.decompress(base64.b64decode(value)).decode("utf-8"))
+    except (TypeError, ValueError, zlib.error):
+        return {}
+
+
+class CartDiff(object):
+    """ Streaming comparison of a cart's items with the last uploaded state.
+
+    `changes` yields added items and items whose copies or identifier
+    changed, then removals with zero copies. The Cart API has no removal
+    call, so with `send_removals` off removals are only dropped from the
+    state: carts whose items may have zero copies can't tell them from an
+    item. Once it is exhausted, `state`
+    holds the fingerprint to store if the changes were accepted: identifier
+    id -> [identifier, copies], with string keys so it survives a JSON
+    round trip. `updates` does the same from the items of a few changed
+    identifier ids, keeping the rest of the previous state.
+    """
+
+    def __init__(self, previous_state, send_removals=True):
+        self.previous_state = previous_state
+        self.send_removals = send_removals
+        self.state = {}
+        self.exhausted = False
+
+    def changes(self, items):
+        """ Filter an iterable of (identifier id, item) pairs. """
+        for identifier_id, item in items:
+            key = str(identifier_id)
+            entry = [item.identifier, item.copies]
+            self.state[key] = entry
+            if self.previous_state.get(key) != entry:
+                yield item
+
+        if self.send_removals:
+            current_identifiers = set(entry[0] for entry in self.state.values())
+            for key, (identifier, copies) in sorted(self.previous_state.items()):
+                if identifier not in current_identifiers:
+                    current_identifiers.add(identifier)
+                    yield Item(identifier, 0)
+        self.exhausted = True
+
+    def updates(self, items, changed_ids):
+        """ Filter the (identifier id, item) pairs of the identifier ids in
+        `changed_ids`, the only ones that may differ from the previous state. """
+        changed_keys = set(str(identifier_id) for identifier_id in changed_ids)
+        self.state = dict((key, entry) for key, entry in self.previous_state.items()
+                          if key not in changed_keys)
+        for identifier_id, item in items:
+            key = str(identifier_id)
+            entry = [item.identifier, item.copies]
+            self.state[key] = entry
+            if self.previous_state.get(key) != entry:
+                yield item
+
+        if self.send_removals:
+            current_identifiers = set(entry[0] for entry in self.state.values())
+            for key in sorted(changed_keys):
+                if key in self.state or key not in self.previous_state:
+                    continue
+                identifier = self.previous_state[key][0]
+                if identifier not in current_identifiers:
+                    current_identifiers.add(identifier)
+                    yield Item(identifier, 0)
+        self.exhausted = True
@@ -0,0 +1,110 @@
+from cm_plugin_cart_api_exchange.cart_api_cache import CollectionLicenseCache, IsbnCache
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestIsbnCache(unittest.TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.clock = lambda: self.now[0]
+
+    def test_get_and_set(self):
+        cache = IsbnCache(clock=self.clock)
+        assert cache.get(1) is None
+        cache.set(1, "1231231231231")
+        assert cache.get(1) == "1231231231231"
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_lru_eviction(self):
+        cache = IsbnCache(max_size=2, clock=self.clock)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+        assert len(cache) == 2
+        assert cache.get(2) is None
+        assert cache.get(1) == "a"
+        assert cache.get(3) == "c"
+
+    def test_ttl(self):
+        cache = IsbnCache(ttl=10, clock=self.clock)
+        cache.set(1, "a")
+        self.now[0] += 11
+        assert cache.get(1) is None
+        assert cache.misses == 1
+
+    def test_validate(self):
+        cache = IsbnCache(clock=self.clock)
+        cache.validate("10:20")
+        cache.set(1, "a")
+        cache.validate("10:20")
+        assert cache.get(1) == "a"
+        cache.validate("11:21")
+        assert cache.get(1) is None
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "isbns.json")
+            cache = IsbnCache(ttl=10, path=path, clock=self.clock)
+            cache.validate("10:20")
+            cache.set(1, "a")
+            self.now[0] += 5
+            cache.set(2, "b")
+            cache.save()
+
+            self.now[0] += 6
+            loaded = IsbnCache(ttl=10, path=path, clock=self.clock)
+            loaded.load()
+            assert loaded.version == "10:20"
+            # the first entry expired in between
+            assert len(loaded) == 1
+            assert loaded.get(2) == "b"
+
+            # a broken file is ignored
+            with open(path, "w") as cache_file:
+                cache_file.write("{")
+            broken = IsbnCache(path=path, clock=self.clock)
+            broken.load()
+            assert len(broken) == 0
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestCollectionLicenseCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = CollectionLicenseCache({1: [10, 11], 2: [10]})
+        assert cache.collections(1) == [10, 11]
+        assert cache.collections(3) is None
+        assert cache.is_shared(10)
+        assert not cache.is_shared(11)
+
+        assert cache.get(10, ("expired", None)) is None
+        cache.set(10, ("expired", None), ["row"])
+        assert cache.get(10, ("expired", None)) == ["row"]
+        assert cache.get(10, ("expired", 5)) is None
+        assert cache.hits == 1
+        assert cache.misses == 2
+
+    def test_release_evicts_unused_collections(self):
+        cache = CollectionLicenseCache({1: [10, 11], 2: [10]})
+        cache.set(10, ("expired", None), ["row"])
+        cache.set(11, ("expired", None), ["other row"])
+
+        cache.release(1)
+        assert cache.collections(1) is None
+        assert cache.get(10, ("expired", None)) == ["row"]
+        assert cache.get(11, ("expired", None)) is None
+        # Releasing twice doesn't drop the references of other libraries
+        cache.release(1)
+        assert len(cache) == 1
+
+        cache.release(2)
+        assert len(cache) == 0
+        # Nothing is stored once no library needs the collection
+        cache.set(10, ("expired", None), ["row"])
+        assert len(cache) == 0
@@ -0,0 +1,29 @@
+from core.testing import DatabaseTest, create
+from core.model.library import Library
+
+from cm_plugin_cart_api_exchange.cart_api_indexes import CartApiIndexScript, INDEXES
+
+
+class TestCartApiIndexScript(DatabaseTest):
+    def test_create_and_drop_indexes(self):
+        script = CartApiIndexScript(_db=self._db)
+        names = [name for name, _, _ in INDEXES]
+
+        assert sorted(script.create_indexes(concurrently=False)) == sorted(names)
+        assert script.existing_indexes() == dict((name, True) for name in names)
+        # Running it again changes nothing
+        assert script.create_indexes(concurrently=False) == []
+
+        assert script.drop_indexes(concurrently=False) == sorted(names)
+        assert script.existing_indexes() == {}
+
+    def test_explain(self):
+        library, _ = create(self._db, Library, name="a-library", short_name="a-l")
+        script = CartApiIndexScript(_db=self._db)
+
+        plans = dict(script.explain(library, vendor_id=1))
+        assert set(plans.keys()) == set([
+            "classify", "classify_vendor", "stream_expired", "changed_identifiers",
+            "identifiers", "equivalent_isbns",
+        ])
+        assert all(plan for plan in plans.values())
@@ -0,0 +1,40 @@
+from cm_plugin_cart_api_exchange.cart_api_items import Item, ItemBatch
+
+import unittest
+
+
+class TestItemBatch(unittest.TestCase):
+    def test_append_items(self):
+        batch = ItemBatch()
+        batch.append(Item("1231231231231", 2))
+        batch.append(Item("1222222222211", None))
+        batch.append({"identifier": "1233333333331", "copies": 3})
+
+        assert len(batch) == 3
+        assert batch.identifiers == ["1231231231231", "1222222222211", "1233333333331"]
+        assert batch.copies.tolist() == [2, 0, 3]
+        assert batch.total_copies == 5
+        assert batch.entries() == [
+            {"id": "1231231231231", "quantity": 2},
+            {"id": "1222222222211", "quantity": 0},
+            {"id": "1233333333331", "quantity": 3},
+        ]
+
+    def test_item_equality(self):
+        assert Item("1231231231231", 1) == Item("1231231231231", 1)
+        assert Item("1231231231231", 1) != Item("1231231231231", 0)
+        assert Item("1231231231231", 1) != {"identifier": "1231231231231", "copies": 1}
+
+    def test_split_and_extend(self):
+        batch = ItemBatch()
+        for n in range(5):
+            batch.add("isbn-%d" % n, n)
+        parts = list(batch.split(2))
+        assert [len(part) for part in parts] == [2, 2, 1]
+        assert parts[1].copies.tolist() == [2, 3]
+
+        joined = ItemBatch()
+        for part in parts:
+            joined.extend(part)
+        assert joined.identifiers == batch.identifiers
+        assert joined.copies == batch.copies
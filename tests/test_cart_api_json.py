@@ -0,0 +1,30 @@
+from cm_plugin_cart_api_exchange.cart_api_json import (
+    JsonSerializer,
+    available_serializers,
+    default_serializer,
+    gzip_bytes,
+)
+
+import gzip
+import io
+import json
+import unittest
+
+
+class TestSerializers(unittest.TestCase):
+    def test_serializers_agree(self):
+        data = {"name": "a cart/1", "total": {"items": 2, "copies": 3},
+                "items": [{"id": "1231231231231", "quantity": 1},
+                          {"id": "1222222222211", "quantity": 2}]}
+        for serializer in available_serializers():
+            content = serializer.dumps(data)
+            assert isinstance(content, bytes)
+            assert json.loads(content.decode("utf-8")) == data
+        assert JsonSerializer().dumps({"id": 1}) == b'{"id":1}'
+        assert default_serializer().name == available_serializers()[0].name
+
+    def test_gzip_bytes(self):
+        content = b'{"items":[]}' * 100
+        compressed = gzip_bytes(content)
+        assert len(compressed) < len(content)
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == content
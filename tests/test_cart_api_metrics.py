@@ -0,0 +1,82 @@
+from cm_plugin_cart_api_exchange.cart_api_metrics import (
+    InMemoryMetrics,
+    JsonFileMetrics,
+    MultiMetrics,
+    StatsdMetrics,
+    current_phase,
+)
+
+from mock import MagicMock
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestInMemoryMetrics(unittest.TestCase):
+    def test_timings_are_aggregated_per_name_and_tags(self):
+        metrics = InMemoryMetrics()
+        metrics.timing("http_patch", 1.0, {"library": "a"})
+        metrics.timing("http_patch", 3.0, {"library": "a"})
+        metrics.timing("http_patch", 0.5, {"library": "b"})
+
+        timings = metrics.timings()
+        assert timings[0] == {"name": "http_patch", "tags": {"library": "a"}, "count": 2,
+                              "total_seconds": 4.0, "max_seconds": 3.0}
+        assert metrics.total("http_patch", by="library") == {"a": 4.0, "b": 0.5}
+
+    def test_timed_records_on_error(self):
+        metrics = InMemoryMetrics()
+        try:
+            with metrics.timed("license_query"):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert metrics.timings()[0]["count"] == 1
+
+    def test_current_phase(self):
+        metrics = InMemoryMetrics()
+        assert current_phase() is None
+        with metrics.timed("license_query"):
+            with metrics.timed("isbn_resolution"):
+                assert current_phase() == "isbn_resolution"
+            assert current_phase() == "license_query"
+        assert current_phase() is None
+
+    def test_counts(self):
+        metrics = InMemoryMetrics()
+        metrics.count("items_sent", 10, {"cart": "x"})
+        metrics.count("items_sent", 5, {"cart": "x"})
+        assert metrics.counts() == [{"name": "items_sent", "tags": {"cart": "x"}, "value": 15}]
+
+
+class TestMetricsSinks(unittest.TestCase):
+    def test_json_file_flush(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "metrics.json")
+            metrics = JsonFileMetrics(path)
+            metrics.timing("config_save", 0.25)
+            metrics.flush()
+            with open(path) as metrics_file:
+                data = json.load(metrics_file)
+            assert data["timings"][0]["name"] == "config_save"
+        finally:
+            shutil.rmtree(directory)
+
+    def test_statsd_lines(self):
+        metrics = StatsdMetrics("localhost", 8125)
+        metrics._socket = MagicMock()
+        metrics.timing("http_patch", 0.1234, {"library": "a", "cart": "b"})
+        metrics.count("items_sent", 3)
+
+        lines = [call[0][0] for call in metrics._socket.sendto.call_args_list]
+        assert lines == [b"cart_api.http_patch:123|ms|#cart:b,library:a",
+                         b"cart_api.items_sent:3|c"]
+
+    def test_multi_metrics_fans_out(self):
+        first, second = InMemoryMetrics(), InMemoryMetrics()
+        metrics = MultiMetrics(first, second)
+        metrics.count("items_sent", 2)
+        assert first.counts() == second.counts()
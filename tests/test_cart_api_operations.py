@@ -1,7 +1,27 @@
-from cm_plugin_cart_api_exchange.cart_api_operations import chunk_dict, ExchangeApi
+from cm_plugin_cart_api_exchange.cart_api_operations import (
+    chunk_dict,
+    chunk_items,
+    AdaptiveChunkSize,
+    AsyncExchangeApi,
+    ExchangeApi,
+    PendingCall,
+    RequestCancelled,
+    RetryPolicy,
+    SendCheckpoint,
+    TokenBucket,
+    parse_retry_after,
+)
+
+from cm_plugin_cart_api_exchange.cart_api_items import Item
+from cm_plugin_cart_api_exchange.cart_api_metrics import InMemoryMetrics
 
 from mock import MagicMock, ANY
+from multiprocessing import TimeoutError as PoolTimeoutError
+import json
+import threading
+import time
 import unittest
+import zlib
 
 
 class TestChunkList(unittest.TestCase):
@@ -43,6 +63,49 @@ class TestChunkList(unittest.TestCase):
         assert len(chunked_lists[0]) == 2
         assert len(chunked_lists[1]) == 1
 
+    def test_chunk_dict_iterable_is_consumed_lazily(self):
+        pulled = []
+
+        def values():
+            for n in range(5):
+                pulled.append(n)
+                yield n
+
+        chunks = chunk_dict(values(), size=2)
+        assert next(chunks) == [0, 1]
+        assert pulled == [0, 1]
+        assert [c for c in chunks] == [[2, 3], [4]]
+
+    def test_chunk_items_follows_sizes(self):
+        chunks = list(chunk_items(range(10), iter([1, 2, 3, 100])))
+        assert chunks == [[0], [1, 2], [3, 4, 5], [6, 7, 8, 9]]
+
+
+class TestAdaptiveChunkSize(unittest.TestCase):
+    def test_grows_towards_target_time(self):
+        sizer = AdaptiveChunkSize(1000, 100, 5000, target_seconds=10)
+        sizer.observe(1000, 1.0)
+        assert sizer.size == 1500
+        for _ in range(10):
+            sizer.observe(sizer.size, sizer.size / 1000.0)
+        assert sizer.size == 5000
+
+    def test_shrinks_when_slow_or_failing(self):
+        sizer = AdaptiveChunkSize(1000, 100, 5000, target_seconds=10)
+        sizer.observe(1000, 40.0)
+        assert sizer.size == 625
+        sizer.observe(625, 1.0, failed=True)
+        assert sizer.size == 312
+        for _ in range(10):
+            sizer.observe(sizer.size, 1.0, failed=True)
+        assert sizer.size == 100
+
+    def test_body_size_is_bounded(self):
+        sizer = AdaptiveChunkSize(1000, 100, 5000, target_seconds=10, max_body_bytes=1000)
+        sizer.observe(1000, 0.1, body_bytes=2000)
+        assert sizer.size == 750
+
+
 class TestExchangeApi(unittest.TestCase):
     def test_send_items(self):
         exchange_api = ExchangeApi("user", "password")
@@ -79,6 +142,11 @@ class TestExchangeApi(unittest.TestCase):
         exchange_api.send_items("a-url", items, "cart-name", 2)
         assert exchange_api._make_patch_request.call_count == 2
 
+        # any iterable of items
+        exchange_api._make_patch_request.reset_mock()
+        exchange_api.send_items("a-url", iter(items.values()), "cart-name", 2)
+        assert exchange_api._make_patch_request.call_count == 2
+
         # Items with error
         class MockResponse:
             def __init__(self):
@@ -94,3 +162,447 @@ class TestExchangeApi(unittest.TestCase):
         }
         exchange_api.send_items("a-url", items, "cart-name", 2)
         assert exchange_api._make_patch_request.call_count == 1
+
+    def test_session_is_reused_and_closed(self):
+        exchange_api = ExchangeApi("user", "password", pool_size=4)
+        session = exchange_api.session
+        assert exchange_api.session is session
+        assert session.auth.username == "user"
+        assert session.auth.password == "password"
+        assert session.get_adapter("https://market.feedbooks.com")._pool_maxsize == 4
+
+        exchange_api.close()
+        assert exchange_api._session is None
+
+    def test_requests_use_session_and_timeout(self):
+        exchange_api = ExchangeApi("user", "password", timeout=(1, 2))
+        exchange_api._session = MagicMock()
+
+        exchange_api._make_patch_request("a-url", {"name": "cart"})
+        exchange_api._make_get_request("a-url", {"name": "cart"})
+
+        exchange_api._session.patch.assert_called_once_with(
+            "a-url", data=b'{"name":"cart"}', headers=ANY, timeout=(1, 2)
+        )
+        exchange_api._session.post.assert_called_once_with(
+            "a-url", json={"name": "cart"}, headers=ANY, timeout=(1, 2)
+        )
+
+    def test_send_items_counts_entry_errors(self):
+        exchange_api = ExchangeApi("user", "password")
+        exchange_api.FAILED_ITEM_PASSES = 0
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"items": [
+            {"id": "1231231231231"},
+            {"id": "1222222222211", "error": "unknown isbn"},
+            {"id": "9999999999999", "error": "not in the chunk"},
+        ]}
+        exchange_api._make_patch_request = MagicMock(return_value=response)
+        items = [Item("1231231231231", 1), Item("1222222222211", 3)]
+        result = exchange_api.send_items("a-url", items, "cart-name")
+
+        assert response.json.call_count == 1
+        assert result.total == 2
+        assert result.total_with_error == 2
+        assert result.failed.identifiers == ["1222222222211"]
+        assert result.failed.copies.tolist() == [3]
+
+    def test_send_items_resends_only_failed_items(self):
+        exchange_api = ExchangeApi("user", "password")
+        rejected = MagicMock(status_code=200)
+        rejected.json.return_value = {"items": [{"id": "1222222222211", "error": "busy"}]}
+        accepted = MagicMock(status_code=200)
+        accepted.json.return_value = {"items": [{"id": "1222222222211"}]}
+        exchange_api._make_patch_request = MagicMock(side_effect=[rejected, accepted])
+
+        items = [Item("1231231231231", 1), Item("1222222222211", 3), Item("1233333333331", 2)]
+        result = exchange_api.send_items("a-url", items, "cart-name")
+
+        resent = exchange_api._make_patch_request.call_args[0][1]
+        assert resent["items"] == [{"id": "1222222222211", "quantity": 3}]
+        assert result.total == 3
+        assert result.total_with_error == 0
+        assert not result.failed
+
+    def test_retries_send_the_same_encoded_body(self):
+        serializer = MagicMock()
+        serializer.dumps.return_value = b"{}"
+        exchange_api = ExchangeApi(
+            "user", "password", serializer=serializer,
+            retry_policy=RetryPolicy(sleep=MagicMock()),
+        )
+        exchange_api._session = MagicMock()
+        exchange_api._session.patch.side_effect = [
+            MagicMock(status_code=503, headers={}), MagicMock(status_code=200),
+        ]
+        exchange_api.send_items("a-url", [Item("1231231231231", 1)], "cart-name")
+
+        assert serializer.dumps.call_count == 1
+        assert exchange_api._session.patch.call_count == 2
+
+    def test_gzip_bodies(self):
+        exchange_api = ExchangeApi("user", "password", gzip=True)
+        exchange_api.GZIP_MIN_BYTES = 0
+        exchange_api._session = MagicMock()
+        exchange_api._session.patch.return_value = MagicMock(status_code=200)
+        items = [Item("1231231231231", 1)]
+        exchange_api.send_items("https://exchange/carts/1", items, "cart-name")
+
+        kwargs = exchange_api._session.patch.call_args[1]
+        assert kwargs["headers"]["Content-Encoding"] == "gzip"
+        data = json.loads(zlib.decompress(kwargs["data"], 16 + zlib.MAX_WBITS).decode("utf-8"))
+        assert data["items"] == [{"id": "1231231231231", "quantity": 1}]
+
+    def test_gzip_is_dropped_for_endpoints_refusing_it(self):
+        exchange_api = ExchangeApi("user", "password", gzip=True)
+        exchange_api.GZIP_MIN_BYTES = 0
+        exchange_api._session = MagicMock()
+        exchange_api._session.patch.side_effect = [
+            MagicMock(status_code=415), MagicMock(status_code=200),
+            MagicMock(status_code=200),
+        ]
+        items = [Item("1231231231231", 1)]
+        result = exchange_api.send_items("https://exchange/carts/1", items, "cart-name")
+        exchange_api.send_items("https://exchange/carts/2", items, "cart-name")
+
+        encodings = [call[1]["headers"].get("Content-Encoding")
+                     for call in exchange_api._session.patch.call_args_list]
+        assert encodings == ["gzip", None, None]
+        assert result.total_with_error == 0
+        assert result.total_retries == 0
+
+    def test_context_manager_closes_session(self):
+        with ExchangeApi("user", "password") as exchange_api:
+            session = MagicMock()
+            exchange_api._session = session
+        session.close.assert_called_once_with()
+        assert exchange_api._session is None
+
+    def test_send_items_concurrently(self):
+        exchange_api = ExchangeApi(
+            "user", "password", max_workers=3, retry_policy=RetryPolicy(max_retries=0)
+        )
+
+        class MockResponse:
+            status_code = 200
+
+            def json(self):
+                return {}
+
+        def patch(url, data, body=None):
+            if data["items"][0]["id"] == "bad":
+                raise Exception("connection reset")
+            return MockResponse()
+
+        exchange_api._make_patch_request = MagicMock(side_effect=patch)
+        items = dict(
+            (n, {"identifier": "isbn-%d" % n, "copies": 1}) for n in range(10)
+        )
+        items[10] = {"identifier": "bad", "copies": 1}
+
+        result = exchange_api.send_items("a-url", items, "cart-name", 1)
+        assert exchange_api._make_patch_request.call_count == 11
+        assert result.chunks == 11
+        assert result.total == 11
+        assert result.total_with_error == 1
+
+        # Sequential and concurrent runs account the same way
+        exchange_api._make_patch_request.reset_mock()
+        sequential = exchange_api.send_items("a-url", items, "cart-name", 1, max_workers=1)
+        assert sequential.total == result.total
+        assert sequential.total_with_error == result.total_with_error
+
+    def test_send_items_drops_repeated_identifiers(self):
+        metrics = InMemoryMetrics()
+        exchange_api = ExchangeApi("user", "password", max_workers=2, metrics=metrics)
+        sent = []
+
+        class MockResponse:
+            status_code = 200
+
+            def json(self):
+                return {}
+
+        def patch(url, data, body=None):
+            sent.extend((item["id"], item["quantity"]) for item in data["items"])
+            return MockResponse()
+
+        exchange_api._make_patch_request = MagicMock(side_effect=patch)
+        items = [Item("isbn-1", 2), Item("isbn-2", 1), Item("isbn-1", 5)]
+
+        result = exchange_api.send_items("a-url", items, "cart-name", 1)
+        assert sorted(sent) == [("isbn-1", 2), ("isbn-2", 1)]
+        assert result.total == 2
+        counts = dict((c["name"], c["value"]) for c in metrics.counts())
+        assert counts["items_duplicated"] == 1
+
+    def test_send_items_retries_transient_errors(self):
+        sleep = MagicMock()
+        exchange_api = ExchangeApi(
+            "user", "password", retry_policy=RetryPolicy(max_retries=2, sleep=sleep)
+        )
+
+        def response(status_code, headers=None):
+            mock = MagicMock(status_code=status_code, headers=headers or {})
+            mock.json.return_value = {}
+            return mock
+
+        items = {1161: {"identifier": "1231231231231", "copies": 1}}
+
+        # 502 then success
+        exchange_api._make_patch_request = MagicMock(
+            side_effect=[response(502), response(200)]
+        )
+        result = exchange_api.send_items("a-url", items, "cart-name")
+        assert exchange_api._make_patch_request.call_count == 2
+        assert result.total_with_error == 0
+        assert result.retries == {1: 1}
+
+        # 429 with Retry-After is honored
+        sleep.reset_mock()
+        exchange_api._make_patch_request = MagicMock(
+            side_effect=[response(429, {"Retry-After": "7"}), response(200)]
+        )
+        result = exchange_api.send_items("a-url", items, "cart-name")
+        sleep.assert_called_once_with(7.0)
+        assert result.total_with_error == 0
+
+        # Gives up after max_retries
+        exchange_api._make_patch_request = MagicMock(
+            side_effect=[Exception("reset"), response(503), response(503)]
+        )
+        result = exchange_api.send_items("a-url", items, "cart-name")
+        assert exchange_api._make_patch_request.call_count == 3
+        assert result.total_with_error == 1
+        assert result.total_retries == 2
+
+        # Client errors are not retried
+        exchange_api._make_patch_request = MagicMock(return_value=response(400))
+        result = exchange_api.send_items("a-url", items, "cart-name")
+        assert exchange_api._make_patch_request.call_count == 1
+        assert result.total_with_error == 1
+
+    def test_send_items_uses_rate_limiter(self):
+        rate_limiter = MagicMock()
+        exchange_api = ExchangeApi("user", "password", rate_limiter=rate_limiter)
+        exchange_api._make_patch_request = MagicMock(
+            return_value=MagicMock(status_code=200)
+        )
+        items = {
+            1161: {"identifier": "1231231231231", "copies": 1},
+            1162: {"identifier": "1222222222211", "copies": 3},
+        }
+        exchange_api.send_items("a-url", items, "cart-name", 1)
+        assert rate_limiter.acquire.call_count == 2
+
+    def test_send_items_records_metrics(self):
+        metrics = InMemoryMetrics()
+        exchange_api = ExchangeApi("user", "password", metrics=metrics)
+        exchange_api._make_patch_request = MagicMock(
+            return_value=MagicMock(status_code=200)
+        )
+        items = {
+            1161: {"identifier": "1231231231231", "copies": 1},
+            1162: {"identifier": "1222222222211", "copies": 3},
+        }
+        tags = {"library": "a-library", "cart": "a-cart"}
+        exchange_api.send_items("a-url", items, "cart-name", 1, metric_tags=tags)
+
+        timings = dict((t["name"], t) for t in metrics.timings())
+        assert timings["http_patch"]["count"] == 2
+        assert timings["http_patch"]["tags"] == tags
+        assert timings["chunk_build"]["count"] == 2
+        counts = dict((c["name"], c["value"]) for c in metrics.counts())
+        assert counts["items_sent"] == 2
+        assert counts["items_with_error"] == 0
+
+
+    def test_send_items_with_chunk_sizer(self):
+        sizer = AdaptiveChunkSize(2, min_size=2, max_size=8, target_seconds=10)
+        exchange_api = ExchangeApi("user", "password", chunk_sizer=sizer)
+        exchange_api._make_patch_request = MagicMock(
+            return_value=MagicMock(status_code=200)
+        )
+        items = [{"identifier": "97800000000%02d" % n, "copies": 1} for n in range(20)]
+        result = exchange_api.send_items("a-url", items, "cart-name")
+
+        sizes = [call[0][1]["total"]["items"]
+                 for call in exchange_api._make_patch_request.call_args_list]
+        assert sizes == [2, 3, 4, 6, 5]
+        assert result.total == 20
+
+
+class TestSendCheckpoint(unittest.TestCase):
+    def send(self, checkpoint, statuses):
+        exchange_api = ExchangeApi("user", "password",
+                                   retry_policy=RetryPolicy(max_retries=0))
+        exchange_api._make_patch_request = MagicMock(side_effect=[
+            MagicMock(status_code=status) for status in statuses
+        ])
+        items = [{"identifier": "97800000000%02d" % n, "copies": n} for n in range(4)]
+        exchange_api.send_items("a-url", items, "cart-name", 1, checkpoint=checkpoint)
+        return exchange_api._make_patch_request.call_count
+
+    def test_accepted_chunks_are_recorded_until_an_error(self):
+        on_progress = MagicMock()
+        checkpoint = SendCheckpoint(on_progress=on_progress)
+        assert self.send(checkpoint, [200, 200, 400, 200]) == 4
+        assert len(checkpoint.chunk_hashes) == 2
+        assert on_progress.call_count == 2
+
+    def test_resume_skips_accepted_chunks(self):
+        first = SendCheckpoint()
+        self.send(first, [200, 200, 400, 200])
+
+        resumed = SendCheckpoint(first.chunk_hashes, first.chunk_sizes)
+        assert self.send(resumed, [200, 200]) == 2
+        assert resumed.skipped == 2
+        assert len(resumed.chunk_hashes) == 4
+
+    def test_changed_items_are_not_skipped(self):
+        checkpoint = SendCheckpoint(["not-a-hash"])
+        assert self.send(checkpoint, [200] * 4) == 4
+        assert checkpoint.skipped == 0
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_parse_retry_after(self):
+        assert parse_retry_after(None) is None
+        assert parse_retry_after(MagicMock(headers={})) is None
+        assert parse_retry_after(MagicMock(headers={"Retry-After": "12"})) == 12
+        assert parse_retry_after(MagicMock(headers={"Retry-After": "soon"})) is None
+        past = MagicMock(headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        assert parse_retry_after(past) == 0
+
+    def test_delay_is_capped_and_jittered(self):
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5)
+        for retries in range(6):
+            delay = policy.delay(retries)
+            assert 0 <= delay <= min(5, 2 ** retries)
+        assert policy.delay(0, MagicMock(headers={"Retry-After": "100"})) == 5
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire_waits_for_refill(self):
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0], sleep=sleep)
+        bucket.acquire()
+        bucket.acquire()
+        assert waits == []
+        bucket.acquire()
+        assert waits == [0.5]
+
+
+class TestAsyncExchangeApi(unittest.TestCase):
+    def test_create_cart_async(self):
+        exchange_api = AsyncExchangeApi("user", "password")
+        exchange_api._session = MagicMock()
+        exchange_api._session.post.return_value.headers = {"Location": "cart-url"}
+
+        pending = exchange_api.create_cart_async("cart-name")
+        assert pending.get(5) == "cart-url"
+        assert exchange_api.create_cart("cart-name") == "cart-url"
+        exchange_api.close()
+
+    def test_concurrency_is_bounded(self):
+        exchange_api = AsyncExchangeApi("user", "password", concurrency=2, max_workers=4)
+        lock = threading.Lock()
+        state = {"running": 0, "max": 0}
+
+        def patch(*args, **kwargs):
+            with lock:
+                state["running"] += 1
+                state["max"] = max(state["max"], state["running"])
+            time.sleep(0.01)
+            with lock:
+                state["running"] -= 1
+            response = MagicMock(status_code=200)
+            response.json.return_value = {}
+            return response
+
+        exchange_api._session = MagicMock()
+        exchange_api._session.patch.side_effect = patch
+        items = dict(
+            (n, {"identifier": "isbn-%d" % n, "copies": 1}) for n in range(8)
+        )
+        pending = [exchange_api.send_items_async("a-url", items, "cart", 1)
+                   for _ in range(3)]
+
+        results = [p.get(5) for p in pending]
+        assert [r.total for r in results] == [8, 8, 8]
+        assert [r.total_with_error for r in results] == [0, 0, 0]
+        assert state["max"] <= 2
+        exchange_api.close()
+
+    def test_send_items_async_takes_send_items_arguments(self):
+        metrics = InMemoryMetrics()
+        exchange_api = AsyncExchangeApi("user", "password", metrics=metrics)
+        exchange_api._session = MagicMock()
+        exchange_api._session.patch.return_value = MagicMock(status_code=200)
+        checkpoint = SendCheckpoint()
+        tags = {"library": "a-library", "cart": "a-cart"}
+        items = [Item("1231231231231", 1), Item("1222222222211", 2)]
+
+        pending = exchange_api.send_items_async(
+            "a-url", items, "cart", chunk_size=1, max_workers=2, metric_tags=tags,
+            checkpoint=checkpoint
+        )
+        assert isinstance(pending, PendingCall)
+        assert pending.get(5).total == 2
+        assert len(checkpoint.chunk_hashes) == 2
+        counts = dict((c["name"], c["value"]) for c in metrics.counts())
+        assert counts["items_sent"] == 2
+        exchange_api.close()
+
+    def test_cancel(self):
+        exchange_api = AsyncExchangeApi("user", "password")
+        exchange_api._session = MagicMock()
+        exchange_api.cancel()
+
+        items = {1: {"identifier": "1231231231231", "copies": 1}}
+        result = exchange_api.send_items("a-url", items, "cart")
+        assert result.total_with_error == 1
+        exchange_api._session.patch.assert_not_called()
+
+        self.assertRaises(RequestCancelled, exchange_api.create_cart, "cart")
+        self.assertRaises(RequestCancelled, exchange_api.create_cart_async("cart").get, 5)
+        exchange_api.close()
+
+    def test_timeout_cancels_the_call(self):
+        exchange_api = AsyncExchangeApi("user", "password", max_workers=2)
+        exchange_api.FAILED_ITEM_PASSES = 0
+        exchange_api._session = MagicMock()
+        calls = []
+        release = threading.Event()
+
+        def patch(*args, **kwargs):
+            calls.append(args)
+            release.wait(5)
+            return MagicMock(status_code=200)
+        exchange_api._session.patch.side_effect = patch
+        items = [Item("isbn-%d" % n, 1) for n in range(6)]
+
+        pending = exchange_api.send_items_async("a-url", items, "cart", 1)
+        # Wait for the first two chunks to be in flight
+        for _ in range(5000):
+            if len(calls) == 2:
+                break
+            time.sleep(0.001)
+        self.assertRaises(PoolTimeoutError, pending.get, 0.01)
+        assert pending.cancelled
+        release.set()
+
+        # Chunks sent after the timeout fail without a request
+        result = pending.get(5)
+        assert exchange_api._session.patch.call_count == 2
+        assert result.total_with_error == 4
+        # Other calls are not cancelled
+        assert not exchange_api.cancelled
+        assert exchange_api.send_items("a-url", items[:1], "cart").total_with_error == 0
+        exchange_api.close()
@@ -0,0 +1,65 @@
+from cm_plugin_cart_api_exchange import cart_api_plugin
+from cm_plugin_cart_api_exchange.cart_api_plugin import (
+    CartApiPlugin,
+    DatasourceOptions,
+    LazyFields,
+)
+from cm_plugin_cart_api_exchange.cart_api_scripts import KEY_DATASOURCE, KEY_USER
+
+from mock import MagicMock, patch
+import unittest
+
+
+class TestDatasourceOptions(unittest.TestCase):
+    def setUp(self):
+        self.now = [0]
+        self.options = DatasourceOptions(ttl=10, clock=lambda: self.now[0])
+        self.script = MagicMock()
+        self.script.return_value.get_datasources.return_value = [
+            {"key": 1, "label": "DPLA Exchange"}
+        ]
+        patcher = patch.object(cart_api_plugin, "GetDatasourcesScript", self.script)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_loaded_once_until_expired(self):
+        assert self.options.get() == [{"key": 1, "label": "DPLA Exchange"}]
+        self.options.get()
+        assert self.script.call_count == 1
+        assert self.script.return_value._db.close.call_count == 1
+
+        self.now[0] = 11
+        self.options.get()
+        assert self.script.call_count == 2
+        assert self.script.return_value._db.close.call_count == 2
+
+    def test_invalidate(self):
+        self.options.get()
+        self.options.invalidate()
+        self.options.get()
+        assert self.script.call_count == 2
+
+    def test_database_unavailable(self):
+        self.script.return_value.get_datasources.side_effect = Exception("no db")
+        assert self.options.get() == []
+        assert self.script.return_value._db.close.call_count == 1
+
+        self.script.return_value.get_datasources.side_effect = None
+        assert self.options.get() == [{"key": 1, "label": "DPLA Exchange"}]
+
+    def test_lazy_fields(self):
+        class Plugin(object):
+            FIELDS = LazyFields(
+                [{"key": KEY_USER}, {"key": KEY_DATASOURCE, "options": []}],
+                self.options
+            )
+
+        assert self.script.call_count == 0
+        fields = Plugin.FIELDS
+        assert fields[0] == {"key": KEY_USER}
+        assert fields[1]["options"] == [{"key": 1, "label": "DPLA Exchange"}]
+
+    def test_plugin_fields(self):
+        keys = [field["key"] for field in CartApiPlugin.FIELDS]
+        assert KEY_DATASOURCE in keys
+        assert KEY_USER in keys
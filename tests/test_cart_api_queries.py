@@ -0,0 +1,54 @@
+from cm_plugin_cart_api_exchange.cart_api_metrics import InMemoryMetrics
+from cm_plugin_cart_api_exchange.cart_api_queries import OTHER_PHASE, QueryRecorder
+
+from sqlalchemy import create_engine, text
+import unittest
+
+
+class TestQueryRecorder(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.connection = self.engine.connect()
+        self.recorder = QueryRecorder(self.connection, slowest=2)
+
+    def tearDown(self):
+        self.recorder.detach()
+        self.connection.close()
+
+    def execute(self, count=1):
+        for n in range(count):
+            self.connection.execute(text("SELECT %d" % n))
+
+    def test_statements_per_phase(self):
+        metrics = InMemoryMetrics()
+        self.execute()
+        with metrics.timed("license_query"):
+            self.execute(3)
+
+        assert self.recorder.count() == 4
+        assert self.recorder.count("license_query") == 3
+        assert self.recorder.count(OTHER_PHASE) == 1
+        phases = dict((p["phase"], p) for p in self.recorder.phases())
+        assert len(phases["license_query"]["slowest"]) == 2
+        assert phases["license_query"]["seconds"] >= 0
+        self.recorder.log_summary()
+
+        self.recorder.reset()
+        assert self.recorder.count() == 0
+        self.recorder.detach()
+        self.execute()
+        assert self.recorder.count() == 0
+
+    def test_assert_max_queries(self):
+        with self.recorder.assert_max_queries(2) as statements:
+            self.execute(2)
+        assert statements == ["SELECT 0", "SELECT 1"]
+
+        try:
+            with self.recorder.assert_max_queries(2):
+                self.execute(3)
+        except AssertionError as err:
+            assert "3 queries, expected at most 2" in str(err)
+            assert "SELECT 2" in str(err)
+        else:
+            raise AssertionError("assert_max_queries didn't fail")
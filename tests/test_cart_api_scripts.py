@@ -1,19 +1,29 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+
 from core.testing import DatabaseTest, create
 from core.model.plugin_configuration import PluginConfiguration
 from core.model.library import Library
 from core.model.work import Work
-from core.model.identifier import Identifier
+from core.model.identifier import Equivalency, Identifier
 from core.model.datasource import DataSource
 from core.model.licensing import LicensePool
 from core.model.collection import Collection, collections_libraries
 from core.model.configuration import ExternalIntegration
 from core.model import get_one_or_create
 
-from mock import MagicMock, ANY
+from mock import MagicMock, ANY, patch
 from sqlalchemy import desc
+from sqlalchemy.orm import Session
 
 from cm_plugin_cart_api_exchange.cart_api_scripts import (
     CartApiScript,
+    LibraryRun,
+    KEY_USER,
     KEY_DATASOURCE,
     KEY_EXPIRED_FROM_DPLA,
     KEY_EXPIRED_FROM_ANY,
@@ -21,10 +31,23 @@ from cm_plugin_cart_api_exchange.cart_api_scripts import (
     KEY_EXPIRING_FROM_ANY,
     KEY_LONG_QUEUE_FROM_DPLA,
     KEY_LONG_QUEUE_FROM_ANY,
+    CHECKPOINT_SUFFIX,
+    STATE_SUFFIX,
+    WATERMARK_SUFFIX,
     TRUE_VALUE,
     FALSE_VALUE,
 )
-from cm_plugin_cart_api_exchange.cart_api_operations import ExchangeApi
+from cm_plugin_cart_api_exchange.cart_api_items import Item
+from cm_plugin_cart_api_exchange.cart_api_spool import LicenseSpool
+from cm_plugin_cart_api_exchange.cart_api_plugin import CartApiPlugin
+from cm_plugin_cart_api_exchange.cart_api_state import decode_state, encode_state
+from cm_plugin_cart_api_exchange.cart_api_operations import (
+    AsyncExchangeApi,
+    ExchangeApi,
+    batch_items,
+)
+from cm_plugin_cart_api_exchange.cart_api_metrics import InMemoryMetrics
+from cm_plugin_cart_api_exchange.cart_api_queries import QueryRecorder
 
 
 class TestCartApiScripts(DatabaseTest):
@@ -65,6 +88,29 @@ class TestCartApiScripts(DatabaseTest):
         )
         self._db.execute(ins)
 
+    def create_license_pool(self, collection=None, **kwargs):
+        """ A license pool with a new identifier, in the test collection by default. """
+        if not hasattr(self, "work"):
+            self.work, _ = create(self._db, Work)
+        kwargs.setdefault("open_access", False)
+        pool, _ = create(
+            self._db, LicensePool, work_id=self.work.id,
+            collection_id=(collection or self.collection).id,
+            identifier_id=self._identifier().id, **kwargs
+        )
+        return pool
+
+    def record_sent_items(self):
+        """ Make `exchange_api.send_items` accept every item. Returns the list
+        the items of each call are appended to. """
+        sent = []
+
+        def send_items(url, items, cart_name, **kwargs):
+            sent.append(list(items))
+            return MagicMock(total_with_error=0)
+        self.exchange_api.send_items.side_effect = send_items
+        return sent
+
     def test_run_with_config(self):
         cart_script = CartApiScript(_db=self._db)
         try:
@@ -75,6 +121,7 @@ class TestCartApiScripts(DatabaseTest):
     def test_run_call_all_carts(self):
         plugin_name = "a-plugin"
         cart_script = CartApiScript(_db=self._db)
+        cart_script._create_missing_carts = MagicMock()
         cart_script._run_expired_items = MagicMock()
         cart_script._run_expiring_items = MagicMock()
         cart_script._run_long_queue_items = MagicMock()
@@ -118,6 +165,413 @@ class TestCartApiScripts(DatabaseTest):
         assert cart_script._run_expiring_items.call_count == 2
         assert cart_script._run_long_queue_items.call_count == 2
 
+    def test_run_shares_exchange_api_per_credentials(self):
+        plugin_name = "a-plugin"
+        cart_script = CartApiScript(_db=self._db)
+        cart_script._create_missing_carts = MagicMock()
+        cart_script._run_expired_items = MagicMock()
+
+        libraries = []
+        for lib_id, user in ((21, "same-user"), (22, "same-user"), (23, "other-user")):
+            library, ignore = create(
+                self._db, Library, id=lib_id, name="library-%d" % lib_id,
+                short_name="l-%d" % lib_id
+            )
+            libraries.append(library)
+            create(
+                self._db, PluginConfiguration, library_id=library.id,
+                key=plugin_name+"."+KEY_USER, _value=user
+            )
+            create(
+                self._db, PluginConfiguration, library_id=library.id,
+                key=plugin_name+"."+KEY_EXPIRED_FROM_ANY, _value=TRUE_VALUE
+            )
+
+        cart_script.run(plugin_name)
+
+        apis = dict(
+            (call[0][2].id, call[0][0])
+            for call in cart_script._run_expired_items.call_args_list
+        )
+        assert apis[21] is apis[22]
+        assert apis[21] is not apis[23]
+
+    def test_run_isolates_library_failures(self):
+        cart_script = CartApiScript(_db=self._db)
+        for lib_id in (31, 32, 33):
+            create(
+                self._db, Library, id=lib_id, name="library-%d" % lib_id,
+                short_name="l-%d" % lib_id
+            )
+
+        def run_library(plugin_name, library):
+            if library.id == 32:
+                raise Exception("broken library")
+        cart_script._run_library = MagicMock(side_effect=run_library)
+
+        library_runs = cart_script.run("a-plugin")
+
+        assert cart_script._run_library.call_count == len(library_runs)
+        failed = [r for r in library_runs if r.error]
+        assert [r.name for r in failed] == ["library-32"]
+        assert all(r.seconds >= 0 for r in library_runs)
+
+    def test_run_libraries_in_workers(self):
+        cart_script = CartApiScript(_db=self._db, library_workers=3)
+        library_ids = set()
+        for lib_id in (41, 42, 43, 44):
+            library, _ = create(
+                self._db, Library, id=lib_id, name="library-%d" % lib_id,
+                short_name="l-%d" % lib_id
+            )
+            library_ids.add(library.id)
+
+        cart_script._run_library_worker = MagicMock(
+            side_effect=lambda plugin_name, engine, library_id: LibraryRun(library_id)
+        )
+        library_runs = cart_script.run("a-plugin")
+
+        assert library_ids.issubset(set(r.name for r in library_runs))
+        for call in cart_script._run_library_worker.call_args_list:
+            plugin_name, engine, library_id = call[0]
+            assert plugin_name == "a-plugin"
+
+        worker_script = cart_script._worker_script(self._db)
+        assert worker_script.isbn_cache is cart_script.isbn_cache
+        assert worker_script._exchange_apis is cart_script._exchange_apis
+        assert worker_script.library_workers == 1
+
+    def test_run_library_in_worker_session(self):
+        # Workers open their own connections, so they only see committed rows
+        bind = self._db.get_bind()
+        setup_db = Session(bind=getattr(bind, "engine", bind))
+        library, _ = create(setup_db, Library, name="worker-library", short_name="w-l")
+        setup_db.commit()
+
+        cart_script = CartApiScript(_db=self._db, library_workers=2)
+        cart_script._exchange_apis = {}
+        cart_script._exchange_apis_lock = threading.Lock()
+        runs = []
+        run_library = CartApiScript._run_library
+
+        def record_run(script, plugin_name, worker_library):
+            runs.append((threading.current_thread(), script, worker_library))
+            return run_library(script, plugin_name, worker_library)
+
+        try:
+            with patch.object(CartApiScript, "_run_library", autospec=True,
+                              side_effect=record_run):
+                library_runs = cart_script._run_libraries_in_workers("a-plugin", [library])
+        finally:
+            setup_db.query(PluginConfiguration).filter(
+                PluginConfiguration.library_id == library.id
+            ).delete()
+            setup_db.delete(library)
+            setup_db.commit()
+            setup_db.close()
+
+        assert [(r.name, r.error) for r in library_runs] == [("worker-library", None)]
+        [(thread, script, worker_library)] = runs
+        assert thread is not threading.current_thread()
+        assert script is not cart_script
+        assert script._db is not self._db
+        assert script.isbn_cache is cart_script.isbn_cache
+        # The library was loaded again in the worker's session, closed afterwards
+        assert worker_library is not library
+        assert worker_library.id == library.id
+        assert worker_library not in script._db
+
+    def test_load_saved_values(self):
+        plugin_name = "a-plugin"
+        cart_script = CartApiScript(_db=self._db)
+        library, _ = create(self._db, Library, id=51, name="library-51", short_name="l-51")
+        other, _ = create(self._db, Library, id=52, name="library-52", short_name="l-52")
+        create(
+            self._db, PluginConfiguration, library_id=library.id,
+            key=plugin_name+"."+KEY_USER, _value="a-user"
+        )
+        create(
+            self._db, PluginConfiguration, library_id=library.id,
+            key="_internal."+plugin_name+"."+KEY_EXPIRED_FROM_ANY, _value="a-url"
+        )
+        create(
+            self._db, PluginConfiguration, library_id=library.id,
+            key="another-plugin."+KEY_USER, _value="another-user"
+        )
+
+        saved_values = cart_script._load_saved_values(plugin_name, [library, other])
+        assert saved_values[library.id] == (
+            {KEY_USER: "a-user"}, {KEY_EXPIRED_FROM_ANY: "a-url"}
+        )
+        assert saved_values[other.id] == ({}, {})
+
+    def test_save_internal_values_only_when_changed(self):
+        cart_script = CartApiScript(_db=self._db)
+        library, _ = create(self._db, Library, id=53, name="library-53", short_name="l-53")
+        internal_values = {KEY_EXPIRED_FROM_ANY: "a-url"}
+        saved_values = dict(internal_values)
+
+        with patch.object(PluginConfiguration, "save_values") as save_values:
+            cart_script._save_internal_values(
+                library, "_internal.a-plugin", internal_values, saved_values
+            )
+            save_values.assert_not_called()
+
+            internal_values[KEY_EXPIRED_FROM_ANY + STATE_SUFFIX] = "a-state"
+            cart_script._save_internal_values(
+                library, "_internal.a-plugin", internal_values, saved_values
+            )
+            assert save_values.call_count == 1
+            assert saved_values == internal_values
+
+    def test_exchange_api_allows_every_upload(self):
+        cart_script = CartApiScript(_db=self._db, library_workers=3, upload_workers=4)
+        cart_script._exchange_apis = {}
+        cart_script._exchange_apis_lock = threading.Lock()
+
+        exchange_api = cart_script._get_exchange_api("user", "password")
+        assert isinstance(exchange_api, AsyncExchangeApi)
+        assert exchange_api.concurrency == 12
+        assert exchange_api.max_workers == 4
+        assert cart_script._get_exchange_api("user", "password") is exchange_api
+
+    def test_create_missing_carts(self):
+        plugin_name = "a-plugin"
+        cart_script = CartApiScript(_db=self._db)
+        exchange_api = MagicMock()
+        exchange_api.create_cart_async.side_effect = lambda cart_name: MagicMock(
+            get=MagicMock(return_value="url/" + cart_name)
+        )
+        cart_script._get_exchange_api = MagicMock(return_value=exchange_api)
+
+        libraries = []
+        for lib_id in (61, 62):
+            library, _ = create(
+                self._db, Library, id=lib_id, name="library-%d" % lib_id,
+                short_name="l-%d" % lib_id
+            )
+            libraries.append(library)
+            for cart_key in (KEY_EXPIRED_FROM_ANY, KEY_EXPIRING_FROM_ANY):
+                create(
+                    self._db, PluginConfiguration, library_id=library.id,
+                    key=plugin_name+"."+cart_key, _value=TRUE_VALUE
+                )
+        create(
+            self._db, PluginConfiguration, library_id=61,
+            key="_internal."+plugin_name+"."+KEY_EXPIRED_FROM_ANY, _value="existing-url"
+        )
+        cart_script._saved_values = cart_script._load_saved_values(plugin_name, libraries)
+
+        cart_script._create_missing_carts(plugin_name, libraries)
+
+        assert exchange_api.create_cart_async.call_count == 3
+        saved = PluginConfiguration().get_saved_values(
+            self._db, "l-61", "_internal."+plugin_name
+        )
+        assert saved[KEY_EXPIRED_FROM_ANY] == "existing-url"
+        assert saved[KEY_EXPIRING_FROM_ANY] == "url/library-61 " + KEY_EXPIRING_FROM_ANY
+        saved = PluginConfiguration().get_saved_values(
+            self._db, "l-62", "_internal."+plugin_name
+        )
+        assert saved[KEY_EXPIRED_FROM_ANY] == "url/library-62 " + KEY_EXPIRED_FROM_ANY
+
+    def test_create_missing_carts_save_failure(self):
+        plugin_name = "a-plugin"
+        cart_script = CartApiScript(_db=self._db)
+        exchange_api = MagicMock()
+        exchange_api.create_cart_async.side_effect = lambda cart_name: MagicMock(
+            get=MagicMock(return_value="url/" + cart_name)
+        )
+        cart_script._get_exchange_api = MagicMock(return_value=exchange_api)
+        library, _ = create(self._db, Library, name="library-61", short_name="l-61")
+        internal_values = {KEY_EXPIRED_FROM_ANY + STATE_SUFFIX: "a-state"}
+        cart_script._saved_values = {
+            library.id: ({KEY_EXPIRED_FROM_ANY: TRUE_VALUE}, internal_values),
+        }
+
+        with patch.object(PluginConfiguration, "save_values", side_effect=ValueError()), \
+                patch.object(cart_script._db, "rollback") as rollback:
+            # Doesn't raise, the library creates its carts when it runs
+            cart_script._create_missing_carts(plugin_name, [library])
+        assert rollback.call_count == 1
+        assert internal_values == {KEY_EXPIRED_FROM_ANY + STATE_SUFFIX: "a-state"}
+
+    def test_classify_licenses(self):
+        self.create_library_and_collection()
+
+        expired = self.create_license_pool(licenses_available=0)
+        expired_dpla = self.create_license_pool(
+            licenses_available=0, data_source_id=self.datasource.id
+        )
+        expiring = self.create_license_pool(licenses_available=3)
+        long_queue_and_expired = self.create_license_pool(
+            licenses_available=0, patrons_in_hold_queue=10
+        )
+        self.create_license_pool(open_access=True, licenses_available=0)
+        self.create_license_pool(licenses_available=50)
+
+        carts = [KEY_EXPIRED_FROM_DPLA, KEY_EXPIRED_FROM_ANY, KEY_EXPIRING_FROM_ANY,
+                 KEY_LONG_QUEUE_FROM_ANY]
+        licenses = self.cart_script._classify_licenses(self.library, carts, self.vendor_id)
+
+        def identifiers(cart_key):
+            return set(l.identifier_id for l in licenses[cart_key])
+
+        assert set(licenses.keys()) == set(carts)
+        assert identifiers(KEY_EXPIRED_FROM_DPLA) == set([expired_dpla.identifier_id])
+        assert identifiers(KEY_EXPIRED_FROM_ANY) == set([
+            expired.identifier_id, expired_dpla.identifier_id,
+            long_queue_and_expired.identifier_id,
+        ])
+        assert identifiers(KEY_EXPIRING_FROM_ANY) == set([expiring.identifier_id])
+        assert identifiers(KEY_LONG_QUEUE_FROM_ANY) == set([
+            long_queue_and_expired.identifier_id
+        ])
+
+        assert self.cart_script._classify_licenses(self.library, [], self.vendor_id) == {}
+
+    def test_split_licenses(self):
+        self.create_library_and_collection()
+        expired = self.create_license_pool(licenses_available=0)
+        expiring = self.create_license_pool(licenses_available=3)
+
+        # A single cart streams its own query
+        assert self.cart_script._split_licenses(
+            self.library, [KEY_EXPIRED_FROM_ANY], None
+        ) == {KEY_EXPIRED_FROM_ANY: None}
+
+        carts = [KEY_EXPIRED_FROM_ANY, KEY_EXPIRING_FROM_ANY]
+        licenses = self.cart_script._split_licenses(self.library, carts, None)
+        assert all(isinstance(rows, list) for rows in licenses.values())
+
+        # With a spool directory, the rows of each cart are kept on disk
+        self.cart_script.spool_dir = tempfile.mkdtemp()
+        try:
+            licenses = self.cart_script._split_licenses(self.library, carts, None)
+            assert all(isinstance(rows, LicenseSpool) for rows in licenses.values())
+            assert [l.identifier_id for l in licenses[KEY_EXPIRED_FROM_ANY]] == \
+                [expired.identifier_id]
+            assert [l.identifier_id for l in licenses[KEY_EXPIRING_FROM_ANY]] == \
+                [expiring.identifier_id]
+            for rows in licenses.values():
+                rows.close()
+        finally:
+            shutil.rmtree(self.cart_script.spool_dir)
+
+    def test_classify_licenses_of_shared_collections(self):
+        self.create_library_and_collection()
+        other_library, _ = create(self._db, Library, name="b-library", short_name="b-l")
+        ext_integ, _ = create(
+            self._db, ExternalIntegration, protocol="test", goal="licenses", name="OtherInteg"
+        )
+        own_collection, _ = create(
+            self._db, Collection, name="b-collection", external_integration_id=ext_integ.id
+        )
+        for collection, library in [(self.collection, other_library),
+                                    (own_collection, other_library)]:
+            self._db.execute(collections_libraries.insert().values(
+                collection_id=collection.id, library_id=library.id
+            ))
+
+        shared = self.create_license_pool(licenses_available=0)
+        own = self.create_license_pool(own_collection, licenses_available=0)
+        self.create_license_pool(licenses_available=3)
+
+        carts = [KEY_EXPIRED_FROM_ANY, KEY_EXPIRING_FROM_ANY]
+        uncached = [self.cart_script._classify_licenses(library, carts, None)
+                    for library in (self.library, other_library)]
+
+        enabled = {KEY_EXPIRED_FROM_ANY: TRUE_VALUE, KEY_EXPIRING_FROM_ANY: TRUE_VALUE}
+        self.cart_script._saved_values = {
+            self.library.id: (enabled, {}), other_library.id: (enabled, {}),
+        }
+        self.cart_script.license_cache = self.cart_script._create_license_cache(
+            [self.library, other_library]
+        )
+        cache = self.cart_script.license_cache
+        assert cache is not None
+        cached = [self.cart_script._classify_licenses(library, carts, None)
+                  for library in (self.library, other_library)]
+
+        def identifiers(licenses, cart_key):
+            return [l.identifier_id for l in licenses[cart_key]]
+
+        for cached_licenses, uncached_licenses in zip(cached, uncached):
+            for cart_key in carts:
+                assert identifiers(cached_licenses, cart_key) == \
+                    identifiers(uncached_licenses, cart_key)
+        assert identifiers(cached[1], KEY_EXPIRED_FROM_ANY) == sorted(
+            [shared.identifier_id, own.identifier_id]
+        )
+        # The shared collection was scanned once, then dropped
+        assert cache.hits == len(carts)
+        assert len(cache) == 0
+
+    def test_resolve_isbns(self):
+        self.create_library_and_collection()
+
+        overdrive = self._identifier(identifier_type=Identifier.OVERDRIVE_ID)
+        weak_isbn = self._identifier(identifier_type=Identifier.ISBN)
+        strong_isbn = self._identifier(identifier_type=Identifier.ISBN)
+        unrated_isbn = self._identifier(identifier_type=Identifier.ISBN)
+        other = self._identifier(identifier_type=Identifier.GUTENBERG_ID)
+        overdrive.equivalent_to(self.datasource, weak_isbn, 0.5)
+        overdrive.equivalent_to(self.datasource, strong_isbn, 1)
+        # Sorted last, where PostgreSQL puts NULLs first in descending order
+        overdrive.equivalent_to(self.datasource, unrated_isbn, None)
+        overdrive.equivalent_to(self.datasource, other, 1)
+
+        without_isbn = self._identifier(identifier_type=Identifier.OVERDRIVE_ID)
+        without_isbn.equivalent_to(self.datasource, other, 1)
+
+        self.cart_script.ISBN_BATCH_SIZE = 2
+        isbns = self.cart_script._resolve_isbns([
+            self.identifier.id, overdrive.id, without_isbn.id
+        ])
+        assert isbns == {
+            self.identifier.id: self.identifier.identifier,
+            overdrive.id: strong_isbn.identifier,
+            without_isbn.id: without_isbn.identifier,
+        }
+
+        # Resolved again from the cache, without queries
+        self.cart_script._query_isbns = MagicMock(return_value={})
+        assert self.cart_script._resolve_isbns([overdrive.id]) == {
+            overdrive.id: strong_isbn.identifier
+        }
+        assert self.cart_script.isbn_cache.hits == 1
+        self.cart_script._query_isbns.assert_called_once_with([])
+
+        # Full scans keep using them too
+        self.cart_script._changed_ids = None
+        self.cart_script._query_isbns.reset_mock()
+        self.cart_script._resolve_isbns([overdrive.id])
+        self.cart_script._query_isbns.assert_called_once_with([])
+
+    def test_equivalencies_version(self):
+        self.create_library_and_collection()
+        overdrive = self._identifier(identifier_type=Identifier.OVERDRIVE_ID)
+        isbn = self._identifier(identifier_type=Identifier.ISBN)
+        versions = [self.cart_script._equivalencies_version()]
+
+        overdrive.equivalent_to(self.datasource, isbn, 0.5)
+        self._db.flush()
+        versions.append(self.cart_script._equivalencies_version())
+
+        # Equivalencies changed in place keep their id
+        equivalency = self._db.query(Equivalency).filter(
+            Equivalency.input_id == overdrive.id
+        ).one()
+        equivalency.strength = 1
+        self._db.flush()
+        versions.append(self.cart_script._equivalencies_version())
+
+        self._db.delete(equivalency)
+        self._db.flush()
+        versions.append(self.cart_script._equivalencies_version())
+
+        assert len(set(versions)) == len(versions)
+
     def test_run_expired_items_with_cart_url(self):
         self.create_library_and_collection()
         internal_value = {KEY_EXPIRED_FROM_DPLA: "dpla-url", KEY_EXPIRED_FROM_ANY: "any-url"}
@@ -154,10 +608,10 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_EXPIRED_FROM_ANY]
+        called_items = list(called_items)
         assert len(called_items) == 1
-        assert license.identifier_id in called_items
-        assert "copies" in called_items[license.identifier_id]
-        assert "identifier" in called_items[license.identifier_id]
+        assert called_items[0].identifier == self.identifier.identifier
+        assert called_items[0].copies == license.licenses_available
 
         # Create with expired license without being DPLA but filtering by DPLA
         self.exchange_api.send_items.reset_mock()
@@ -178,8 +632,222 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, self.vendor_id)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_EXPIRED_FROM_DPLA]
+        called_items = list(called_items)
         assert len(called_items) == 1
 
+    def test_run_expired_items_sends_only_changes(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        self.record_sent_items()
+
+        license = self.create_license_pool(licenses_available=0)
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        assert self.exchange_api.send_items.call_count == 1
+        assert KEY_EXPIRED_FROM_ANY + STATE_SUFFIX in internal_value
+
+        # Nothing changed
+        self.exchange_api.send_items.reset_mock()
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        self.exchange_api.send_items.assert_not_called()
+
+        # The title left the cart: a removal would read as an item with no
+        # copies, so it is only dropped from the state
+        self.exchange_api.send_items.reset_mock()
+        license.licenses_available = 3
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        self.exchange_api.send_items.assert_not_called()
+        assert decode_state(internal_value[KEY_EXPIRED_FROM_ANY + STATE_SUFFIX]) == {}
+
+    def test_run_expiring_items_sends_removals_apart_from_items(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRING_FROM_ANY: "any-url"}
+        sent = self.record_sent_items()
+
+        license = self.create_license_pool(licenses_available=2)
+        isbn = license.identifier.identifier
+        self.cart_script._run_expiring_items(self.exchange_api, internal_value, self.library, None)
+        added = sent[-1]
+        assert added == [Item(isbn, 2)]
+
+        # The title left the cart
+        license.licenses_available = 0
+        self.cart_script._run_expiring_items(self.exchange_api, internal_value, self.library, None)
+        removed = sent[-1]
+        assert removed == [Item(isbn, 0)]
+        assert [item.copies for item in added] != [item.copies for item in removed]
+
+    def test_run_expired_items_records_metrics(self):
+        self.create_library_and_collection()
+        self.cart_script.metrics = InMemoryMetrics()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+
+        self.create_license_pool(licenses_available=0)
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+
+        tags = {"library": self.library.name, "cart": KEY_EXPIRED_FROM_ANY}
+        assert self.exchange_api.send_items.call_args[1]["metric_tags"] == tags
+
+    def test_run_expired_items_resumes_from_checkpoint(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        checkpoint_key = KEY_EXPIRED_FROM_ANY + CHECKPOINT_SUFFIX
+
+        def send_items(url, items, cart_name, checkpoint=None, **kwargs):
+            chunks = list(checkpoint.skip_acknowledged(enumerate(batch_items(items, [10]), 1)))
+            for chunk_number, chunk in chunks:
+                checkpoint.acknowledge(chunk_number, True)
+            sent.append(chunks)
+            return MagicMock(total_with_error=1)
+        self.exchange_api.send_items.side_effect = send_items
+
+        self.create_license_pool(licenses_available=0)
+        sent = []
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        assert len(sent[0]) == 1
+        assert checkpoint_key in internal_value
+
+        # The accepted chunk is not sent again
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        assert sent[1] == []
+
+        # The checkpoint of another cart is ignored
+        del internal_value[KEY_EXPIRED_FROM_ANY]
+        self.cart_script._get_or_create_cart = MagicMock(return_value=("name", "new-url"))
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        assert len(sent[2]) == 1
+
+    def test_incremental_scan(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        carts = [KEY_EXPIRED_FROM_ANY]
+        sent = self.record_sent_items()
+
+        def run():
+            sent_before = len(sent)
+            self.cart_script._scan_licenses(self.library, internal_value, carts, None)
+            licenses = self.cart_script._split_licenses(self.library, carts, None)
+            self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library,
+                                                licenses=licenses[KEY_EXPIRED_FROM_ANY])
+            return [[item.identifier for item in items] for items in sent[sent_before:]]
+
+        checked = datetime.datetime(2020, 1, 1)
+        first = self.create_license_pool(licenses_available=0, last_checked=checked)
+        old = self.create_license_pool(
+            licenses_available=0, last_checked=checked - datetime.timedelta(days=1)
+        )
+        first_isbn = first.identifier.identifier
+
+        # The first run scans everything
+        assert len(run()[0]) == 2
+        assert self.cart_script._changed_ids is None
+        assert KEY_EXPIRED_FROM_ANY + WATERMARK_SUFFIX in internal_value
+
+        # Only the licenses changed since then are scanned
+        assert run() == []
+        assert self.cart_script._changed_ids == [first.identifier_id]
+
+        later = checked + datetime.timedelta(hours=1)
+        first.licenses_available = 2
+        first.last_checked = later
+        added = self.create_license_pool(licenses_available=0, last_checked=later)
+        assert run() == [[added.identifier.identifier, first_isbn]]
+        assert set(self.cart_script._changed_ids) == set([first.identifier_id,
+                                                          added.identifier_id])
+        assert old.identifier_id not in self.cart_script._changed_ids
+
+        # Past INCREMENTAL_MAX_CHANGES, changed ids are no longer all read
+        self.cart_script.INCREMENTAL_MAX_CHANGES = 1
+        assert len(self.cart_script._changed_identifiers(self.library, 1)) == 2
+        old.last_checked = later
+        added.last_checked = later
+        assert run() == []
+        assert self.cart_script._changed_ids is None
+        del self.cart_script.INCREMENTAL_MAX_CHANGES
+
+        # Periodic full scan
+        self.cart_script.FULL_RESCAN_SECONDS = 0
+        time.sleep(0.01)
+        assert run() == []
+        assert self.cart_script._changed_ids is None
+
+    def test_scan_watermark_between_runs(self):
+        internal_value = {
+            KEY_EXPIRED_FROM_ANY: "any-url", KEY_EXPIRED_FROM_ANY + STATE_SUFFIX: encode_state({}),
+        }
+
+        def scan_watermark(full_scan_age):
+            internal_value[KEY_EXPIRED_FROM_ANY + WATERMARK_SUFFIX] = encode_state({
+                "last_change": 1.0, "full_scan": time.time() - full_scan_age, "vendor": None,
+            })
+            return self.cart_script._scan_watermark(internal_value, [KEY_EXPIRED_FROM_ANY], None)
+
+        # The next run of the plugin, a bit later than its frequency, is incremental
+        run_seconds = CartApiPlugin.FREQUENCY * 60 * 60
+        assert self.cart_script.FULL_RESCAN_SECONDS % run_seconds == 0
+        assert scan_watermark(run_seconds + 60 * 60) is not None
+        assert scan_watermark(self.cart_script.FULL_RESCAN_SECONDS + 60) is None
+
+    def test_run_expired_items_queries_do_not_grow_with_licenses(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        for _ in range(30):
+            self.create_license_pool(licenses_available=0)
+        self._db.flush()
+        sent = self.record_sent_items()
+
+        recorder = QueryRecorder(self._db.get_bind())
+        try:
+            # The licenses, their identifiers and their equivalencies
+            with recorder.assert_max_queries(3):
+                self.cart_script._run_expired_items(
+                    self.exchange_api, internal_value, self.library, None
+                )
+        finally:
+            recorder.detach()
+        assert len(sent[0]) == 30
+        assert recorder.count("isbn_resolution") == 2
+
+    def test_failed_upload_keeps_previous_state(self):
+        self.create_library_and_collection()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        self.exchange_api.send_items.return_value = MagicMock(total_with_error=1)
+
+        self.create_license_pool(licenses_available=0)
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+        assert self.exchange_api.send_items.call_count == 2
+        assert KEY_EXPIRED_FROM_ANY + STATE_SUFFIX not in internal_value
+
+    def test_run_expired_items_spools_before_upload(self):
+        self.create_library_and_collection()
+        self.cart_script.spool_dir = tempfile.mkdtemp()
+        internal_value = {KEY_EXPIRED_FROM_ANY: "any-url"}
+        sent = self.record_sent_items()
+
+        license = self.create_license_pool(licenses_available=0)
+        try:
+            self.cart_script._run_expired_items(self.exchange_api, internal_value, self.library, None)
+            self.exchange_api.send_items.assert_not_called()
+            assert os.listdir(self.cart_script.spool_dir) == [
+                "%d-%s.ndjson" % (self.library.id, KEY_EXPIRED_FROM_ANY)
+            ]
+
+            self.cart_script._upload_spooled()
+            assert sent == [[Item(license.identifier.identifier, 0)]]
+            assert KEY_EXPIRED_FROM_ANY + STATE_SUFFIX in internal_value
+            assert os.listdir(self.cart_script.spool_dir) == []
+        finally:
+            shutil.rmtree(self.cart_script.spool_dir)
+
+    def test_replay_spools_without_spool_dir(self):
+        cart_script = CartApiScript(_db=self._db)
+        try:
+            cart_script.replay_spools({"user": "password"})
+        except ValueError as err:
+            assert "SPOOL_DIR" in str(err)
+        else:
+            raise AssertionError("replay_spools didn't fail")
+
     def test_run_expiring_items_with_cart_url(self):
         self.create_library_and_collection()
         internal_value = {KEY_EXPIRING_FROM_DPLA: "dpla-url", KEY_EXPIRING_FROM_ANY: "any-url"}
@@ -226,10 +894,10 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_expiring_items(self.exchange_api, internal_value, self.library, None)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_EXPIRING_FROM_ANY]
+        called_items = list(called_items)
         assert len(called_items) == 1
-        assert license.identifier_id in called_items
-        assert "copies" in called_items[license.identifier_id]
-        assert "identifier" in called_items[license.identifier_id]
+        assert called_items[0].identifier == self.identifier.identifier
+        assert called_items[0].copies == license.licenses_available
 
         # Create with expiring license without being DPLA but filtering by DPLA
         self.exchange_api.send_items.reset_mock()
@@ -250,6 +918,7 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_expiring_items(self.exchange_api, internal_value, self.library, self.vendor_id)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_EXPIRING_FROM_DPLA]
+        called_items = list(called_items)
         assert len(called_items) == 1
 
     def test_run_long_queue_items_with_cart_url(self):
@@ -288,10 +957,10 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_long_queue_items(self.exchange_api, internal_value, self.library, None)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_LONG_QUEUE_FROM_ANY]
+        called_items = list(called_items)
         assert len(called_items) == 1
-        assert license.identifier_id in called_items
-        assert "copies" in called_items[license.identifier_id]
-        assert "identifier" in called_items[license.identifier_id]
+        assert called_items[0].identifier == self.identifier.identifier
+        assert called_items[0].copies == license.licenses_available
 
         # Create with long queue license without being DPLA but filtering by DPLA
         self.exchange_api.send_items.reset_mock()
@@ -312,5 +981,6 @@ class TestCartApiScripts(DatabaseTest):
         self.cart_script._run_long_queue_items(self.exchange_api, internal_value, self.library, self.vendor_id)
         called_url, called_items, _ = self.exchange_api.send_items.call_args[0]
         assert called_url == internal_value[KEY_LONG_QUEUE_FROM_DPLA]
+        called_items = list(called_items)
         assert len(called_items) == 1
 
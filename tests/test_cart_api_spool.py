@@ -0,0 +1,72 @@
+from cm_plugin_cart_api_exchange.cart_api_items import Item
+from cm_plugin_cart_api_exchange.cart_api_spool import CartSpool, LicenseRow, LicenseSpool
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestCartSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        spool = CartSpool.for_cart(self.directory, 1, "expired-from-any")
+        assert os.path.basename(spool.path) == "1-expired-from-any.ndjson"
+        items = [Item("1231231231231", 1), Item("1222222222211", 0)]
+        header = {"cart_key": "expired-from-any", "cart_url": "a-url"}
+
+        assert spool.write(header, iter(items), lambda: "a-state") == 2
+        assert not os.path.exists(spool.path + ".tmp")
+
+        spool = CartSpool.find(self.directory)[0]
+        assert spool.read_header()["cart_url"] == "a-url"
+        assert spool.state is None
+        assert list(spool.items()) == items
+        assert spool.state == "a-state"
+
+        spool.remove()
+        assert CartSpool.find(self.directory) == []
+
+    def test_failed_write_leaves_no_spool(self):
+        spool = CartSpool.for_cart(self.directory, 1, "a-cart")
+
+        def items():
+            yield Item("1231231231231", 1)
+            raise ValueError()
+        try:
+            spool.write({}, items(), lambda: None)
+        except ValueError:
+            pass
+        assert os.listdir(self.directory) == []
+
+    def test_unknown_header(self):
+        path = os.path.join(self.directory, "a-cart.ndjson")
+        with open(path, "w") as spool_file:
+            spool_file.write('{"version": 0}\n')
+        assert CartSpool(path).read_header() is None
+
+
+class TestLicenseSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_read(self):
+        spool = LicenseSpool(self.directory)
+        rows = [LicenseRow(1161, 0, 10, 3), LicenseRow(1162, 2, None, None)]
+        for row in rows:
+            spool.append(row)
+        assert len(spool) == 2
+        assert list(spool) == rows
+        # Rows can be read again
+        assert [row.identifier_id for row in spool] == [1161, 1162]
+
+        spool.close()
+        assert os.listdir(self.directory) == []
@@ -0,0 +1,104 @@
+from cm_plugin_cart_api_exchange.cart_api_items import Item
+from cm_plugin_cart_api_exchange.cart_api_state import (
+    CartDiff,
+    decode_state,
+    encode_state,
+)
+
+import unittest
+
+
+class TestCartState(unittest.TestCase):
+    def test_encode_decode_round_trip(self):
+        state = {"1161": ["1231231231231", 2], "1162": ["1222222222211", 0]}
+        encoded = encode_state(state)
+        assert decode_state(encoded) == state
+
+        assert decode_state(None) == {}
+        assert decode_state("") == {}
+        assert decode_state("not-a-state") == {}
+
+
+class TestCartDiff(unittest.TestCase):
+    def test_changes(self):
+        items = [
+            (1161, Item("1231231231231", 1)),
+            (1162, Item("1222222222211", 3)),
+        ]
+
+        # Nothing sent before: everything is new
+        diff = CartDiff({})
+        changes = diff.changes(iter(items))
+        assert not diff.exhausted
+        assert list(changes) == [item for _, item in items]
+        assert diff.exhausted
+        assert diff.state == {
+            "1161": ["1231231231231", 1], "1162": ["1222222222211", 3],
+        }
+
+        # Same items: nothing to send
+        state = diff.state
+        diff = CartDiff(state)
+        assert list(diff.changes(items)) == []
+        assert diff.state == state
+
+        # Changed copies, a new item and a removed one
+        items = [
+            (1161, Item("1231231231231", 2)),
+            (1163, Item("1233333333331", 1)),
+        ]
+        changes = list(CartDiff(state).changes(items))
+        assert changes == [
+            Item("1231231231231", 2),
+            Item("1233333333331", 1),
+            Item("1222222222211", 0),
+        ]
+
+    def test_removals_can_be_left_out(self):
+        previous = {"1161": ["1231231231231", 0], "1162": ["1222222222211", 0]}
+        items = [(1161, Item("1231231231231", 0))]
+
+        diff = CartDiff(previous, send_removals=False)
+        assert list(diff.changes(items)) == []
+        assert diff.exhausted
+        assert diff.state == {"1161": ["1231231231231", 0]}
+
+        diff = CartDiff(previous, send_removals=False)
+        assert list(diff.updates([], [1162])) == []
+        assert diff.state == {"1161": ["1231231231231", 0]}
+
+    def test_identifiers_still_in_cart_are_not_removed(self):
+        previous = {"1161": ["1231231231231", 1]}
+        # Another identifier now resolves to the same ISBN
+        items = [(1170, Item("1231231231231", 1))]
+        changes = list(CartDiff(previous).changes(items))
+        assert changes == [Item("1231231231231", 1)]
+
+    def test_updates(self):
+        previous = {
+            "1161": ["1231231231231", 1],
+            "1162": ["1222222222211", 3],
+            "1163": ["1233333333331", 1],
+        }
+        # 1161 changed copies, 1162 left the cart and 1164 joined it
+        items = [
+            (1161, Item("1231231231231", 2)),
+            (1164, Item("1244444444441", 1)),
+        ]
+        diff = CartDiff(previous)
+        changes = list(diff.updates(items, [1161, 1162, 1164]))
+        assert changes == [
+            Item("1231231231231", 2),
+            Item("1244444444441", 1),
+            Item("1222222222211", 0),
+        ]
+        assert diff.exhausted
+        assert diff.state == {
+            "1161": ["1231231231231", 2],
+            "1163": ["1233333333331", 1],
+            "1164": ["1244444444441", 1],
+        }
+
+        # A changed identifier whose item didn't change is not sent
+        diff = CartDiff(diff.state)
+        assert list(diff.updates([(1163, Item("1233333333331", 1))], [1163])) == []